@@ -0,0 +1,926 @@
+import os
+import re
+import sys
+import json
+import time
+import itertools
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import threading
+import importlib.util
+import statistics
+import subprocess
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+# 离线压测脚本：启动本地假OpenAI/Telegram Bot API服务，通过 OPENAI_BASE_URL 和 Bot API 地址让机器人的处理函数直接访问它
+# 用法: python3 bench-bot.py loadtest --latency 0.2 --users 1,2,4,8,16,32
+#       python3 bench-bot.py sessions --count 100000 [--db sessions.db]
+#       python3 bench-bot.py settings --users 100000
+#       python3 bench-bot.py replay [--updates updates.jsonl] [--count 1000 --chats 50 --group-users 0]
+#       python3 bench-bot.py markdown [--size-kb 100 --delta 8 --edit-every 50]
+#       python3 bench-bot.py suite [--scenarios chat,message,stream,redo,draw,voice] [--requests 200 --concurrency 16] [--think-time 0.5 --redo-prefetch]
+#       python3 bench-bot.py startup [--users 100000 --runs 5]
+#       python3 bench-bot.py workers [--workers 3 --count 300 --chats 30]
+#       python3 bench-bot.py priority [--users 8 --concurrency 4 --slow-latency 1.0 --slo 0.5]
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get-bot.py')
+BOT_USER = {'id': 999, 'is_bot': True, 'first_name': 'BenchBot', 'username': 'bench_bot'}
+# 压测时关闭准入控制
+NO_RATE_LIMITS = {
+    f'RATE_LIMIT_{kind}_{scope}': '0'
+    for kind in ('CHAT', 'IMAGE', 'AUDIO') for scope in ('USER', 'CHAT', 'GLOBAL')
+}
+MULTIPART_FIELD_PATTERN = re.compile(rb'name="(\w+)"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', re.S)
+
+
+# 假后端服务：/v1/... 模拟OpenAI，/bot<token>/<method> 和 /file/bot<token>/... 模拟Telegram Bot API
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency: float = 0.1
+    telegram_latency: float = 0.0
+    message_ids = itertools.count(1)
+    # 流式响应中相邻两个增量之间的间隔（秒）
+    chunk_delay: float = 0.02
+    reply: str = '这是一个来自假OpenAI服务的回答。'
+    # 按模型单独设置的延迟（秒），未设置的模型使用 latency
+    model_latencies: Dict[str, float] = {}
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', '0'))
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: Any) -> None:
+        self._send(200, json.dumps(data).encode())
+
+    def _send_stream(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for i in range(0, len(self.reply), 4):
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': 'fake',
+                'choices': [{'index': 0, 'delta': {'content': self.reply[i:i + 4]}, 'finish_reason': None}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+    def _parse_params(self, body: bytes) -> Dict[str, str]:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            return {name.decode(): value.decode(errors='replace') for name, value in MULTIPART_FIELD_PATTERN.findall(body)}
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _message(self, chat_id: int, text: str = '', message_id: Optional[int] = None) -> dict:
+        return {
+            'message_id': message_id or next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+    def _telegram(self, method: str, body: bytes) -> None:
+        params = self._parse_params(body)
+        time.sleep(self.telegram_latency)
+        chat_id = int(params.get('chat_id') or 0)
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'editMessageText':
+            result = self._message(chat_id, params.get('text', ''), int(params.get('message_id') or 0))
+        elif method in ('sendMessage', 'sendVoice', 'sendPhoto'):
+            result = self._message(chat_id, params.get('text', ''))
+        elif method == 'sendMediaGroup':
+            result = [self._message(chat_id) for _ in json.loads(params.get('media') or '[]')]
+        elif method == 'getFile':
+            result = {'file_id': params.get('file_id', ''), 'file_unique_id': 'fake', 'file_size': 4096, 'file_path': 'voice/fake.ogg'}
+        else:
+            result = True
+        self._send_json({'ok': True, 'result': result})
+
+    def do_GET(self) -> None:
+        if self.path.startswith('/file/'):
+            self._send(200, b'\x00' * 4096, 'audio/ogg')
+        else:
+            self._send(404, b'{}')
+
+    def do_POST(self) -> None:
+        body = self._read_body()
+        if self.path.startswith('/bot'):
+            self._telegram(self.path.rsplit('/', 1)[-1], body)
+            return
+        params = json.loads(body or b'{}') if self.path.endswith('/chat/completions') else {}
+        time.sleep(self.model_latencies.get(params.get('model'), self.latency))
+        if self.path.endswith('/chat/completions') and params.get('stream'):
+            self._send_stream()
+        elif self.path.endswith('/chat/completions'):
+            self._send_json({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': 'fake',
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': self.reply},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+            })
+        elif self.path.endswith('/audio/transcriptions'):
+            self._send_json({'text': '你好'})
+        elif self.path.endswith('/audio/speech'):
+            self._send(200, b'\x00' * 4096, 'audio/mpeg')
+        elif self.path.endswith('/images/generations'):
+            self._send_json({'created': int(time.time()), 'data': [{'url': 'https://example.com/fake.png'}]})
+        else:
+            self._send(404, b'{}')
+
+
+def start_fake_backend(latency: float, telegram_latency: float = 0.0, chunk_delay: float = FakeBackendHandler.chunk_delay,
+                       model_latencies: Dict[str, float] = None) -> ThreadingHTTPServer:
+    handler = type('ConfiguredFakeBackendHandler', (FakeBackendHandler,), {
+        'latency': latency,
+        'telegram_latency': telegram_latency,
+        'chunk_delay': chunk_delay,
+        'model_latencies': model_latencies or {},
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def backend_url(server: ThreadingHTTPServer) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# 在临时目录中加载机器人模块，避免读写真实的配置文件
+def load_bot(base_url: str, env: Dict[str, str] = None):
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-bench')
+    os.environ.setdefault('ADMIN_ID', '1')
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.update(env or {})
+    os.chdir(tempfile.mkdtemp(prefix='bench-bot-'))
+    spec = importlib.util.spec_from_file_location('get_bot', BOT_FILE)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+# 假Telegram对象：只实现处理函数用到的接口
+class FakeBot:
+    id = 999
+
+    def __init__(self):
+        self._next_message_id = 0
+        self.calls = 0
+
+    def new_message(self, chat_id: int, text: str = ''):
+        self._next_message_id += 1
+        return SimpleNamespace(message_id=self._next_message_id, chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs: Any):
+        self.calls += 1
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs: Any) -> bool:
+        self.calls += 1
+        return True
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any):
+        self.calls += 1
+        return self.new_message(chat_id, text)
+
+
+def make_update(bot: FakeBot, user_id: int, chat_id: int, text: str):
+    async def reply_text(reply: str, **kwargs: Any):
+        bot.calls += 1
+        return bot.new_message(chat_id, reply)
+
+    message = SimpleNamespace(message_id=bot.new_message(chat_id).message_id, text=text, voice=None, reply_to_message=None, reply_text=reply_text)
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, full_name=f'user{user_id}'),
+        effective_chat=SimpleNamespace(id=chat_id),
+        message=message,
+    )
+
+
+def make_context(bot: FakeBot, args: List[str] = None):
+    return SimpleNamespace(bot=bot, args=args or [])
+
+
+# 并发用户压测：每个用户依次发送若干条 /chat，统计总吞吐量
+async def run_loadtest(bot_module, users: int, requests_per_user: int) -> float:
+    fake_bot = FakeBot()
+    bot_module.allowed_users.update(1000 + n for n in range(users))
+
+    async def user_loop(user_id: int) -> None:
+        for i in range(requests_per_user):
+            update = make_update(fake_bot, user_id, user_id, f'问题 {i}')
+            await bot_module.chat_command(update, make_context(fake_bot, ['问题', str(i)]))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user_loop(1000 + n) for n in range(users)))
+    elapsed = time.perf_counter() - start
+    return users * requests_per_user / elapsed
+
+
+def cmd_loadtest(args: argparse.Namespace) -> None:
+    server = start_fake_backend(args.latency)
+    bot_module = load_bot(f'{backend_url(server)}/v1', NO_RATE_LIMITS)
+
+    async def run_all() -> None:
+        print(f'假OpenAI延迟: {args.latency:.3f}s, 每用户请求数: {args.requests}')
+        print(f'{"并发用户":>8} {"吞吐量(req/s)":>14}')
+        for users in (int(n) for n in args.users.split(',')):
+            throughput = await run_loadtest(bot_module, users, args.requests)
+            print(f'{users:>8} {throughput:>14.2f}')
+
+    asyncio.run(run_all())
+    server.shutdown()
+
+
+# 会话存储内存测试：创建大量会话，统计内存占用和淘汰情况
+def cmd_sessions(args: argparse.Namespace) -> None:
+    env = {
+        'SESSION_MAX_COUNT': str(args.max_count),
+        'SESSION_MAX_MEMORY_MB': str(args.max_memory_mb),
+        'SESSION_DB': os.path.abspath(args.db) if args.db else '',
+    }
+    bot_module = load_bot('http://127.0.0.1:9/v1', env)
+    store = bot_module.create_session_store()
+
+    async def fill() -> None:
+        for n in range(args.count):
+            key = bot_module.get_session_key(1000 + n, 1000 + n)
+            session = store.new(key)
+            for turn in range(args.turns):
+                session.append('user', f'第{turn}个问题：请解释一下这个概念。')
+                session.append('assistant', '这是一个示例回答。' * 10)
+            await store.save(key)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    asyncio.run(fill())
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'会话数: {args.count}, 每个会话轮数: {args.turns}, 后端: {args.db or "内存"}')
+    print(f'耗时: {elapsed:.2f}s ({args.count / elapsed:.0f} 会话/s)')
+    print(f'内存中会话数: {len(store)}, 淘汰数: {store.evictions}')
+    print(f'估算会话内存: {store.total_bytes / 1024 / 1024:.1f} MB')
+    print(f'实际内存: 当前 {current / 1024 / 1024:.1f} MB, 峰值 {peak / 1024 / 1024:.1f} MB')
+    if len(store):
+        print(f'平均每个会话: {current / len(store):.0f} 字节')
+
+
+# 旧版 get_user_setting 的实现，用作对比基准
+def legacy_get_user_setting(user_settings: dict, user_id: int, chat_id: int, key: str, default: Any) -> Any:
+    user_id_str = str(user_id)
+    chat_id_str = str(chat_id)
+    if user_id_str in user_settings:
+        if chat_id_str in user_settings[user_id_str].get("chats", {}):
+            return user_settings[user_id_str]["chats"][chat_id_str].get(key,
+                   user_settings[user_id_str]["global"].get(key, default))
+        else:
+            return user_settings[user_id_str]["global"].get(key, default)
+    return default
+
+
+# 设置查找微基准：处理一条消息时解析 model/voice/stream_output 的开销
+def cmd_settings(args: argparse.Namespace) -> None:
+    bot_module = load_bot('http://127.0.0.1:9/v1')
+    store = bot_module.settings_store
+    store._ensure_loaded()
+    for n in range(args.users):
+        user_id = 1000 + n
+        store.data[str(user_id)] = {
+            'global': {'model': 'gpt-4', 'voice': 'nova'},
+            'chats': {str(-user_id): {'stream_output': True}},
+        }
+    lookups = [(1000 + (n * 7919) % args.users, -(1000 + (n * 7919) % args.users)) for n in range(args.lookups)]
+    models = bot_module.MODELS
+
+    def legacy() -> None:
+        data = store.data
+        for user_id, chat_id in lookups:
+            legacy_get_user_setting(data, user_id, chat_id, 'model', models[0])
+            legacy_get_user_setting(data, user_id, chat_id, 'voice', 'onyx')
+            legacy_get_user_setting(data, user_id, chat_id, 'stream_output', False)
+
+    def effective() -> None:
+        get_effective_settings = bot_module.get_effective_settings
+        for user_id, chat_id in lookups:
+            settings = get_effective_settings(user_id, chat_id)
+            settings.model, settings.voice, settings.stream_output
+
+    print(f'用户数: {args.users}, 查找次数: {args.lookups}')
+    for name, func in (('旧版(3次get_user_setting)', legacy), ('EffectiveSettings(冷缓存)', effective), ('EffectiveSettings(热缓存)', effective)):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f'{name:<28} {elapsed / args.lookups * 1e9:>8.0f} ns/次')
+
+
+# 构造一个包含标题、列表、行内格式和代码块的长回答
+def synthesize_markdown(size: int) -> str:
+    paragraph = '这是一段 **重要** 的说明，包含 `inline_code()`、*斜体*、snake_case_name 以及 a < b && c > d 这样的符号。\n'
+    code = '```python\n' + ''.join(f'value_{i} = items[{i}] if a < b and c & d else None  # 第{i}行\n' for i in range(40)) + '```\n'
+    section = '## 小节标题\n' + paragraph * 8 + '- 列表项 [链接](https://example.com/a_b?x=1&y=2)\n' * 5 + code
+    return (section * (size // len(section) + 1))[:size]
+
+
+HTML_TAG_PATTERN = re.compile(r'<(/?)(\w+)[^>]*>')
+
+
+# 检查一条消息的HTML：标签正确嵌套且不超过长度上限，有问题时返回说明
+def check_telegram_html(html_text: str) -> Optional[str]:
+    if len(html_text) > 4096:
+        return f'长度 {len(html_text)} 超过上限'
+    stack = []
+    for match in HTML_TAG_PATTERN.finditer(html_text):
+        closing, tag = match.groups()
+        if not closing:
+            stack.append(tag)
+        elif not stack or stack.pop() != tag:
+            return f'</{tag}> 没有正确嵌套（位置 {match.start()}）'
+    if stack:
+        return f'没有关闭的标签: {", ".join(stack)}'
+    return None
+
+
+# 格式化的回归用例：交叉的强调；代码块的开始标签正好让消息换到下一条
+def markdown_regression_cases() -> List[str]:
+    cases = ['a **b _c** d_', '~~x **y~~ z**\n**a *b* c** 和 _d **e_ f**']
+    for size in range(4040, 4100):
+        cases.append(('x' * 9 + '\n') * (size // 10) + 'y' * (size % 10) + '\n```python\nprint(1)\n```\n')
+    return cases
+
+
+# Markdown渲染基准：流式输出时每次编辑都重新渲染整个前缀 vs 增量格式化
+def cmd_markdown(args: argparse.Namespace) -> None:
+    bot_module = load_bot('http://127.0.0.1:9/v1')
+    text = synthesize_markdown(args.size_kb * 1024)
+    deltas = [text[i:i + args.delta] for i in range(0, len(text), args.delta)]
+
+    def full_rerender() -> int:
+        prefix = ''
+        edits = 0
+        for i, delta in enumerate(deltas):
+            prefix += delta
+            if i % args.edit_every == 0:
+                bot_module.format_reply(prefix)
+                edits += 1
+        bot_module.format_reply(prefix)
+        return edits
+
+    def incremental() -> int:
+        formatter = bot_module.TelegramFormatter()
+        edits = 0
+        for i, delta in enumerate(deltas):
+            formatter.feed(delta)
+            if i % args.edit_every == 0:
+                formatter.render(len(formatter.chunks) - 1, with_pending=True)
+                edits += 1
+        formatter.finish()
+        for index in range(len(formatter.chunks)):
+            formatter.render(index)
+        return edits
+
+    chunks = bot_module.format_reply(text)
+    print(f'回答长度: {len(text)} 字符, 增量: {len(deltas)} 个, 每 {args.edit_every} 个增量编辑一次, '
+          f'分为 {len(chunks)} 条消息（最长 {max(len(html) for html, _ in chunks)} 字符）')
+    for name, func in (('每次编辑重新渲染全文', full_rerender), ('增量格式化', incremental)):
+        start = time.perf_counter()
+        edits = func()
+        elapsed = time.perf_counter() - start
+        print(f'{name:<12} 总耗时 {elapsed * 1000:>9.1f} ms, 每次编辑 {elapsed / edits * 1e6:>9.1f} µs')
+
+    # 基准文本和回归用例的每条消息都必须是Telegram能解析的HTML
+    cases = [text] + markdown_regression_cases()
+    failures = []
+    for case in cases:
+        for index, (html_text, _) in enumerate(bot_module.format_reply(case)):
+            problem = check_telegram_html(html_text)
+            if problem is not None:
+                failures.append(f'用例 {case[:30]!r}... 第 {index + 1} 条消息: {problem}')
+    if failures:
+        print('\n'.join(failures))
+        raise SystemExit(f'HTML检查: {len(failures)} 条消息有问题')
+    print(f'HTML检查: {len(cases)} 个用例全部通过')
+
+
+# 构造合成的更新：group_users 为0时是私聊文本消息，否则是群组中 group_users 个用户轮流发送的 /chat
+def synthesize_updates(count: int, chats: int, group_users: int = 0) -> List[dict]:
+    updates = []
+    for n in range(count):
+        if group_users:
+            chat = {'id': -(2000 + n % chats), 'type': 'group', 'title': f'group{n % chats}'}
+            user_id = 5000 + n // chats % group_users
+            text = f'/chat 第{n}个问题'
+        else:
+            chat = {'id': 2000 + n % chats, 'type': 'private'}
+            user_id = chat['id']
+            text = f'第{n}个问题'
+        message = {
+            'message_id': n + 1,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': text,
+        }
+        if group_users:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': 5}]
+        updates.append({'update_id': n + 1, 'message': message})
+    return updates
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# 构建完整的 Application（真实的处理函数和更新处理器），Bot API 指向假后端
+def build_bench_application(bot_module, server: ThreadingHTTPServer):
+    builder = (
+        bot_module.Application.builder()
+        .base_url(f'{backend_url(server)}/bot')
+        .base_file_url(f'{backend_url(server)}/file/bot')
+    )
+    return bot_module.build_application(builder)
+
+
+# 回放更新：按记录的顺序交给 Application 的更新处理器，统计每秒处理的更新数
+async def run_replay(bot_module, application, updates: List[dict]) -> None:
+    for data in updates:
+        sender = (data.get('message') or {}).get('from') or {}
+        if 'id' in sender:
+            bot_module.allowed_users.add(sender['id'])
+
+    await application.initialize()
+    latencies = []
+
+    async def process(data: dict) -> None:
+        update = bot_module.Update.de_json(data, application.bot)
+        start = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(process(data) for data in updates))
+    elapsed = time.perf_counter() - start
+    await application.shutdown()
+
+    print(f'更新数: {len(updates)}, 耗时: {elapsed:.2f}s, 吞吐量: {len(updates) / elapsed:.1f} updates/s')
+    print(f'更新延迟(含同一会话内排队): p50 {percentile(latencies, 0.5) * 1000:.0f}ms, p99 {percentile(latencies, 0.99) * 1000:.0f}ms')
+
+
+def cmd_replay(args: argparse.Namespace) -> None:
+    server = start_fake_backend(args.latency, args.telegram_latency)
+    bot_module = load_bot(f'{backend_url(server)}/v1', {**NO_RATE_LIMITS, 'CONCURRENT_UPDATES': str(args.concurrency)})
+    updates = load_updates(args.updates) if args.updates else synthesize_updates(args.count, args.chats, args.group_users)
+    application = build_bench_application(bot_module, server)
+    asyncio.run(run_replay(bot_module, application, updates))
+    server.shutdown()
+
+
+# 基准套件：用真实的 Update/Bot 对象直接调用各处理函数，Bot API 和 OpenAI 都指向假后端
+SUITE_SCENARIOS = ('chat', 'message', 'stream', 'redo', 'draw', 'voice')
+
+
+def make_update_data(update_id: int, user_id: int, text: str = '', voice: bool = False) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+    }
+    if voice:
+        message['voice'] = {'file_id': f'voice-{update_id}', 'file_unique_id': f'voice-{update_id}', 'duration': 3}
+    else:
+        message['text'] = text
+    return {'update_id': update_id, 'message': message}
+
+
+async def run_scenario(bot_module, application, scenario: str, requests: int, concurrency: int, think_time: float) -> dict:
+    update_ids = itertools.count(1)
+    user_ids = [3000 + n for n in range(concurrency)]
+    bot_module.allowed_users.update(user_ids)
+    for user_id in user_ids:
+        bot_module.set_user_setting(user_id, user_id, 'stream_output', scenario == 'stream')
+
+    def context_for(update, args: List[str] = None):
+        context = application.context_types.context.from_update(update, application)
+        context.args = args or []
+        return context
+
+    def update_for(user_id: int, text: str = '', voice: bool = False):
+        return bot_module.Update.de_json(make_update_data(next(update_ids), user_id, text, voice), application.bot)
+
+    async def one_request(user_id: int, n: int) -> None:
+        if scenario == 'chat':
+            update = update_for(user_id, f'/chat 问题 {n}')
+            await bot_module.chat_command(update, context_for(update, ['问题', str(n)]))
+        elif scenario in ('message', 'stream'):
+            update = update_for(user_id, f'第{n}个问题')
+            await bot_module.handle_message(update, context_for(update))
+        elif scenario == 'redo':
+            update = update_for(user_id, '/redo')
+            await bot_module.redo(update, context_for(update))
+        elif scenario == 'draw':
+            update = update_for(user_id, '/draw 一只猫')
+            await bot_module.draw(update, context_for(update, ['一只猫', str(n)]))
+            # /draw 只提交任务，等待后台生成完成
+            for job in list(bot_module.draw_queue.inflight.values()):
+                if job.user_id == user_id:
+                    await job.done.wait()
+        elif scenario == 'voice':
+            update = update_for(user_id, voice=True)
+            await bot_module.handle_message(update, context_for(update))
+
+    # /redo 需要已有的对话，先为每个用户准备一轮（不计入统计）
+    if scenario == 'redo':
+        for user_id in user_ids:
+            update = update_for(user_id, '准备')
+            await bot_module.handle_message(update, context_for(update))
+    # 预热：每个场景先处理一个不计入统计的请求，首次调用的开销（懒加载、建立连接等）不会算到某个场景的 p99 里
+    await one_request(user_ids[0], 0)
+
+    latencies = []
+    errors_before = sum(bot_module.errors_total.values.values())
+
+    async def worker(user_id: int, count: int) -> None:
+        for n in range(count):
+            start = time.perf_counter()
+            await one_request(user_id, n)
+            latencies.append(time.perf_counter() - start)
+            # 模拟用户阅读回答的时间（不计入延迟）
+            if think_time:
+                await asyncio.sleep(think_time)
+
+    per_worker = [requests // concurrency + (1 if n < requests % concurrency else 0) for n in range(concurrency)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user_id, count) for user_id, count in zip(user_ids, per_worker)))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'scenario': scenario,
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'peak_mb': peak / 1024 / 1024,
+        'errors': int(sum(bot_module.errors_total.values.values()) - errors_before),
+    }
+
+
+def cmd_suite(args: argparse.Namespace) -> None:
+    server = start_fake_backend(args.latency, args.telegram_latency, args.chunk_delay)
+    bot_module = load_bot(f'{backend_url(server)}/v1', {
+        **NO_RATE_LIMITS, 'RESPONSE_CACHE_ENABLED': 'false', 'REDO_PREFETCH': str(args.redo_prefetch).lower(),
+    })
+    application = build_bench_application(bot_module, server)
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SUITE_SCENARIOS)
+    if unknown:
+        raise SystemExit(f'未知的场景: {", ".join(sorted(unknown))}')
+
+    async def run_all() -> List[dict]:
+        await application.initialize()
+        # 和正式运行一样执行 post_init，等OpenAI客户端预热完成再开始计时，否则第一个场景要承担导入openai的耗时
+        await bot_module.post_init(application)
+        await application.bot_data['openai_warmup']
+        try:
+            return [await run_scenario(bot_module, application, name, args.requests, args.concurrency, args.think_time) for name in scenarios]
+        finally:
+            await bot_module.draw_queue.shutdown()
+            await application.shutdown()
+
+    results = asyncio.run(run_all())
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f'假OpenAI延迟: {args.latency:.3f}s, 假Telegram延迟: {args.telegram_latency:.3f}s, '
+          f'请求数: {args.requests}, 并发: {args.concurrency}')
+    print(f'{"场景":<8} {"吞吐量(req/s)":>14} {"p50(ms)":>9} {"p99(ms)":>9} {"峰值内存(MB)":>12} {"错误":>6}')
+    for result in results:
+        print(f'{result["scenario"]:<8} {result["throughput"]:>14.2f} {result["p50"] * 1000:>9.0f} '
+              f'{result["p99"] * 1000:>9.0f} {result["peak_mb"]:>12.1f} {result["errors"]:>6}')
+    if args.redo_prefetch:
+        prefetches = {dict(key)['result']: int(value) for key, value in bot_module.redo_prefetch_results.values.items()}
+        print('/redo 预取: ' + '，'.join(f'{name} {count}' for name, count in sorted(prefetches.items())))
+
+
+# 在全新的解释器中运行：导入机器人模块，再依次测量构建Application、第一次和第二次查找设置、创建OpenAI客户端的耗时
+STARTUP_PROBE = """
+import sys, json, time, resource, importlib.util
+timings = {}
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('get_bot', sys.argv[1])
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+timings['import'] = time.perf_counter() - start
+steps = (
+    ('build', bot.build_application),
+    ('first_lookup', lambda: bot.get_effective_settings(int(sys.argv[2]), int(sys.argv[2]))),
+    ('second_lookup', lambda: bot.get_effective_settings(1000, -1000)),
+    ('openai_client', bot.get_openai_clients),
+)
+for name, func in steps:
+    start = time.perf_counter()
+    func()
+    timings[name] = time.perf_counter() - start
+timings['rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps(timings))
+"""
+
+
+# 生成有 users 个用户设置的 user_models.json：indexed 为每个用户一行的快照格式，否则为旧版的单行格式
+def write_settings_file(filename: str, users: int, indexed: bool) -> None:
+    data = {
+        str(1000 + n): {'global': {'model': 'gpt-4', 'voice': 'nova'}, 'chats': {str(-(1000 + n)): {'stream_output': True}}}
+        for n in range(users)
+    }
+    with open(filename, 'w') as f:
+        if indexed:
+            f.write('{\n' + ',\n'.join(f'{json.dumps(key)}: {json.dumps(value)}' for key, value in data.items()) + '\n}\n')
+        else:
+            json.dump(data, f)
+
+
+# 冷启动基准：每次启动一个新进程，避免模块缓存和已导入的依赖影响结果
+def cmd_startup(args: argparse.Namespace) -> None:
+    env = {**os.environ, 'TELEGRAM_BOT_TOKEN': '123456:bench', 'OPENAI_API_KEY': 'sk-bench', 'ADMIN_ID': '1'}
+    formats = (('每用户一行', True), ('旧版单行', False), ('无设置文件', None))
+    print(f'用户数: {args.users}, 每种格式运行 {args.runs} 次，取中位数')
+    print(f'{"设置文件":<10} {"导入(ms)":>9} {"构建(ms)":>9} {"首次查找(ms)":>13} {"再次查找(ms)":>13} {"OpenAI客户端(ms)":>17} {"峰值RSS(MB)":>12}')
+    for name, indexed in formats:
+        workdir = tempfile.mkdtemp(prefix='bench-bot-startup-')
+        with open(os.path.join(workdir, 'allowed_users.json'), 'w') as f:
+            json.dump([1000 + n for n in range(args.users)], f)
+        if indexed is not None:
+            write_settings_file(os.path.join(workdir, 'user_models.json'), args.users, indexed)
+        runs = []
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_PROBE, BOT_FILE, str(1000 + args.users - 1)],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f'{name:<10} {median["import"] * 1000:>9.0f} {median["build"] * 1000:>9.0f} '
+              f'{median["first_lookup"] * 1000:>13.1f} {median["second_lookup"] * 1000:>13.3f} '
+              f'{median["openai_client"] * 1000:>17.0f} {median["rss_mb"]:>12.1f}')
+
+
+# 等待 condition() 为真，返回等待的秒数
+async def wait_until(condition, timeout: float = 10.0) -> float:
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('等待共享状态同步超时')
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - start
+
+
+# 多进程部署测试：在同一个进程中加载多份机器人模块作为多个工作进程，共用一个本地SQLite共享存储；
+# 检查管理员修改和用户设置的同步延迟，以及所有更新从0号进程进入后是否按聊天归属分配
+async def run_workers(workers: list, count: int, chats: int) -> None:
+    handled: List[Dict[int, int]] = [{} for _ in workers]
+    for index, (bot_module, application) in enumerate(workers):
+        original = application.update_processor.do_process_update
+
+        async def counted(update, coroutine, index=index, original=original):
+            await original(update, coroutine)
+            chat_id = update.effective_chat.id
+            handled[index][chat_id] = handled[index].get(chat_id, 0) + 1
+
+        application.update_processor.do_process_update = counted
+        await application.initialize()
+        await bot_module.post_init(application)
+        await application.start()
+
+    first_module, first_application = workers[0]
+    try:
+        admin = first_module.Update.de_json(make_update_data(1, 1, '/add_user 4242'), first_application.bot)
+        context = first_application.context_types.context.from_update(admin, first_application)
+        context.args = ['4242']
+        start = time.perf_counter()
+        await first_module.add_user(admin, context)
+        delay = time.perf_counter() - start + await wait_until(lambda: all(4242 in bot_module.allowed_users for bot_module, _ in workers))
+        print(f'/add_user 同步到所有进程（含处理命令）: {delay * 1000:.1f} ms')
+
+        for bot_module, _ in workers:
+            await bot_module.settings_store.prefetch(4242)
+        start = time.perf_counter()
+        first_module.set_user_setting(4242, 4242, 'model', 'gpt-4')
+        await first_module.settings_store.flush()
+        delay = time.perf_counter() - start + await wait_until(lambda: all(bot_module.get_effective_settings(4242, 4242).model == 'gpt-4' for bot_module, _ in workers))
+        print(f'用户设置同步到所有进程（含写入共享存储）: {delay * 1000:.1f} ms')
+
+        updates = synthesize_updates(count, chats)
+        for bot_module, _ in workers:
+            bot_module.allowed_users.update(2000 + n for n in range(chats))
+        start = time.perf_counter()
+        for data in updates:
+            await first_application.update_queue.put(first_module.Update.de_json(data, first_application.bot))
+        await wait_until(lambda: sum(sum(counts.values()) for counts in handled) >= count, timeout=300)
+        elapsed = time.perf_counter() - start
+    finally:
+        for bot_module, application in workers:
+            await application.stop()
+            await application.shutdown()
+            await bot_module.post_shutdown(application)
+
+    print(f'更新数: {count}, 聊天数: {chats}, 耗时: {elapsed:.2f}s, 吞吐量: {count / elapsed:.1f} updates/s')
+    owners = {}
+    for index, counts in enumerate(handled):
+        forwarded = int(sum(workers[index][0].forwarded_updates.values.values()))
+        print(f'  进程 {index}: 处理 {sum(counts.values())} 个更新（{len(counts)} 个聊天），转发出 {forwarded} 个')
+        for chat_id in counts:
+            owners.setdefault(chat_id, set()).add(index)
+    split = [chat_id for chat_id, indexes in owners.items() if len(indexes) > 1]
+    print(f'被多个进程处理的聊天数: {len(split)}')
+
+
+def cmd_workers(args: argparse.Namespace) -> None:
+    server = start_fake_backend(args.latency, args.telegram_latency)
+    shared_path = os.path.join(tempfile.mkdtemp(prefix='bench-bot-shared-'), 'shared.db')
+    workers = []
+    for worker_id in range(args.workers):
+        bot_module = load_bot(f'{backend_url(server)}/v1', {
+            **NO_RATE_LIMITS,
+            'SHARED_STATE_URL': f'sqlite:///{shared_path}',
+            'SHARED_STATE_POLL_INTERVAL': str(args.poll_interval),
+            'WORKER_ID': str(worker_id),
+            'WORKER_COUNT': str(args.workers),
+        })
+        workers.append((bot_module, build_bench_application(bot_module, server)))
+    asyncio.run(run_workers(workers, args.count, args.chats))
+    server.shutdown()
+
+
+# 优先级调度和模型降级：OpenAI并发名额不足时，管理员、白名单用户的私聊和群组同时发送 /chat，统计各类请求的延迟；
+# 默认模型的假延迟为 slow_latency，开启 MODEL_SLO_CHAT 后应在积累足够样本后改用其他模型
+async def run_priority(bot_module, users: int, requests_per_user: int) -> Dict[str, List[float]]:
+    fake_bot = FakeBot()
+    private_users = [2000 + n for n in range(users)]
+    bot_module.allowed_users.update(private_users)
+    latencies: Dict[str, List[float]] = {'admin': [], 'private': [], 'group': []}
+
+    async def user_loop(kind: str, user_id: int, chat_id: int) -> None:
+        for i in range(requests_per_user):
+            update = make_update(fake_bot, user_id, chat_id, f'问题 {i}')
+            start = time.perf_counter()
+            await bot_module.chat_command(update, make_context(fake_bot, ['问题', str(i)]))
+            latencies[kind].append(time.perf_counter() - start)
+
+    loops = [user_loop('admin', bot_module.Config.ADMIN_ID, bot_module.Config.ADMIN_ID)]
+    loops += [user_loop('private', user_id, user_id) for user_id in private_users]
+    # 群组流量是私聊的两倍
+    loops += [user_loop('group', 3000 + n, -(3000 + n)) for n in range(users * 2)]
+    await asyncio.gather(*loops)
+    return latencies
+
+
+def cmd_priority(args: argparse.Namespace) -> None:
+    # 机器人模块加载后才知道默认模型，先启动假后端再设置它的延迟
+    server = start_fake_backend(args.latency)
+    bot_module = load_bot(f'{backend_url(server)}/v1', {
+        **NO_RATE_LIMITS,
+        'OPENAI_MAX_CONCURRENCY': str(args.concurrency),
+        'MODEL_SLO_CHAT': str(args.slo),
+        'MODEL_SLO_MIN_SAMPLES': str(args.min_samples),
+    })
+    slow_model = bot_module.MODELS[0]
+    server.RequestHandlerClass.model_latencies = {slow_model: args.slow_latency}
+    latencies = asyncio.run(run_priority(bot_module, args.users, args.requests))
+    server.shutdown()
+
+    print(f'OpenAI并发上限: {args.concurrency}, 默认模型 {slow_model} 延迟: {args.slow_latency:.3f}s, '
+          f'其他模型延迟: {args.latency:.3f}s, MODEL_SLO_CHAT: {args.slo}')
+    print(f'{"类型":<8} {"请求数":>6} {"p50(ms)":>9} {"p99(ms)":>9}')
+    for kind, samples in latencies.items():
+        print(f'{kind:<8} {len(samples):>6} {percentile(samples, 0.5) * 1000:>9.0f} {percentile(samples, 0.99) * 1000:>9.0f}')
+    fallbacks = {dict(key)['fallback']: int(value) for key, value in bot_module.model_fallbacks.values.items()}
+    print('模型降级: ' + ('，'.join(f'{slow_model} -> {model} {count} 次' for model, count in fallbacks.items()) or '无'))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='GPT Telegram Bot 离线压测')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    loadtest = subparsers.add_parser('loadtest', help='并发用户吞吐量测试')
+    loadtest.add_argument('--latency', type=float, default=0.2, help='假OpenAI服务每个请求的延迟（秒）')
+    loadtest.add_argument('--users', default='1,2,4,8,16,32', help='逗号分隔的并发用户数')
+    loadtest.add_argument('--requests', type=int, default=5, help='每个用户发送的请求数')
+    loadtest.set_defaults(func=cmd_loadtest)
+
+    sessions = subparsers.add_parser('sessions', help='会话存储内存测试')
+    sessions.add_argument('--count', type=int, default=100000, help='创建的会话数')
+    sessions.add_argument('--turns', type=int, default=3, help='每个会话的对话轮数')
+    sessions.add_argument('--max-count', type=int, default=1000000, help='SESSION_MAX_COUNT')
+    sessions.add_argument('--max-memory-mb', type=float, default=4096, help='SESSION_MAX_MEMORY_MB')
+    sessions.add_argument('--db', default='', help='SQLite会话文件，留空则只使用内存')
+    sessions.set_defaults(func=cmd_sessions)
+
+    settings = subparsers.add_parser('settings', help='设置查找微基准')
+    settings.add_argument('--users', type=int, default=100000, help='有设置的用户数')
+    settings.add_argument('--lookups', type=int, default=200000, help='查找次数')
+    settings.set_defaults(func=cmd_settings)
+
+    replay = subparsers.add_parser('replay', help='回放Telegram更新，测试每秒处理的更新数')
+    replay.add_argument('--updates', default='', help='记录的更新（每行一个Update JSON），留空则使用合成的更新')
+    replay.add_argument('--count', type=int, default=1000, help='合成的更新数')
+    replay.add_argument('--chats', type=int, default=50, help='合成更新分布的聊天数')
+    replay.add_argument('--group-users', type=int, default=0, help='大于0时合成群组中这么多个用户轮流发送的 /chat')
+    replay.add_argument('--concurrency', type=int, default=64, help='CONCURRENT_UPDATES')
+    replay.add_argument('--latency', type=float, default=0.2, help='假OpenAI服务每个请求的延迟（秒）')
+    replay.add_argument('--telegram-latency', type=float, default=0.02, help='假Telegram服务每个请求的延迟（秒）')
+    replay.set_defaults(func=cmd_replay)
+
+    markdown = subparsers.add_parser('markdown', help='长回答的Markdown渲染基准')
+    markdown.add_argument('--size-kb', type=int, default=100, help='回答长度（KB）')
+    markdown.add_argument('--delta', type=int, default=8, help='每个流式增量的字符数')
+    markdown.add_argument('--edit-every', type=int, default=50, help='每多少个增量编辑一次消息')
+    markdown.set_defaults(func=cmd_markdown)
+
+    suite = subparsers.add_parser('suite', help='逐个场景调用处理函数，统计延迟分位数、吞吐量和内存')
+    suite.add_argument('--scenarios', default=','.join(SUITE_SCENARIOS), help='逗号分隔的场景: ' + ', '.join(SUITE_SCENARIOS))
+    suite.add_argument('--requests', type=int, default=200, help='每个场景的请求总数')
+    suite.add_argument('--concurrency', type=int, default=16, help='并发用户数')
+    suite.add_argument('--latency', type=float, default=0.2, help='假OpenAI服务每个请求的延迟（秒）')
+    suite.add_argument('--telegram-latency', type=float, default=0.02, help='假Telegram服务每个请求的延迟（秒）')
+    suite.add_argument('--chunk-delay', type=float, default=FakeBackendHandler.chunk_delay, help='流式响应增量之间的间隔（秒）')
+    suite.add_argument('--think-time', type=float, default=0.0, help='每个用户两次请求之间的间隔（秒，不计入延迟）')
+    suite.add_argument('--redo-prefetch', action='store_true', help='开启 /redo 预取（REDO_PREFETCH=true）')
+    suite.add_argument('--json', action='store_true', help='以JSON输出结果，便于和基线比较')
+    suite.set_defaults(func=cmd_suite)
+
+    startup = subparsers.add_parser('startup', help='冷启动基准：导入模块、构建Application和第一次查找设置的耗时')
+    startup.add_argument('--users', type=int, default=100000, help='user_models.json 和 allowed_users.json 中的用户数')
+    startup.add_argument('--runs', type=int, default=5, help='每种设置文件格式启动的次数')
+    startup.set_defaults(func=cmd_startup)
+
+    workers = subparsers.add_parser('workers', help='多进程部署：共享状态同步延迟和按聊天归属转发更新')
+    workers.add_argument('--workers', type=int, default=3, help='工作进程数（WORKER_COUNT）')
+    workers.add_argument('--count', type=int, default=300, help='从0号进程进入的更新数')
+    workers.add_argument('--chats', type=int, default=30, help='更新分布的聊天数')
+    workers.add_argument('--poll-interval', type=float, default=0.01, help='SHARED_STATE_POLL_INTERVAL')
+    workers.add_argument('--latency', type=float, default=0.05, help='假OpenAI服务每个请求的延迟（秒）')
+    workers.add_argument('--telegram-latency', type=float, default=0.01, help='假Telegram服务每个请求的延迟（秒）')
+    workers.set_defaults(func=cmd_workers)
+
+    priority = subparsers.add_parser('priority', help='优先级调度和按延迟自动换模型')
+    priority.add_argument('--users', type=int, default=8, help='私聊用户数（群组用户数为两倍，另有一个管理员）')
+    priority.add_argument('--requests', type=int, default=5, help='每个用户发送的 /chat 数')
+    priority.add_argument('--concurrency', type=int, default=4, help='OPENAI_MAX_CONCURRENCY')
+    priority.add_argument('--latency', type=float, default=0.2, help='假OpenAI服务中其他模型的延迟（秒）')
+    priority.add_argument('--slow-latency', type=float, default=1.0, help='假OpenAI服务中默认模型的延迟（秒）')
+    priority.add_argument('--slo', type=float, default=0.5, help='MODEL_SLO_CHAT，0表示不自动换模型')
+    priority.add_argument('--min-samples', type=int, default=5, help='MODEL_SLO_MIN_SAMPLES')
+    priority.set_defaults(func=cmd_priority)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
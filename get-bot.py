@@ -1,21 +1,73 @@
 import os
+import re
+import sys
 import json
+import hashlib
+import mmap
+import time
+import logging
 import tempfile
 import asyncio
-from typing import Dict, Set, Any, Optional
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ChatMemberHandler
+import sqlite3
+import threading
+import random
+import signal
+import functools
+import heapq
+import itertools
+import email.utils
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
+from typing import TYPE_CHECKING, Dict, Set, Any, Optional, AsyncIterator, Awaitable, Callable, Iterator, Tuple
+from telegram import Update, Message, InputMediaPhoto
+from telegram.ext import Application, ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, ContextTypes, filters, ChatMemberHandler
 from telegram.constants import ParseMode
-from openai import OpenAI
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
+import httpx
 from dotenv import load_dotenv
 
+# openai 导入较慢（约0.5秒），在第一次创建客户端时才导入
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+try:
+    import tiktoken  # 可选依赖，用于精确计算token数
+except ImportError:
+    tiktoken = None
+
+try:
+    import redis  # 可选依赖，多进程部署时用作共享存储
+except ImportError:
+    redis = None
+
 # 常量定义
 MODELS_FILE = 'models.json'
 USERS_FILE = 'allowed_users.json'
 USER_SETTINGS_FILE = 'user_models.json'
+MODEL_CONTEXT_FILE = 'model_context.json'
+UPSTREAMS_FILE = 'upstreams.json'
+GROUP_CONTEXT_FILE = 'group_context.json'
 DEFAULT_MODELS = ['gpt-3.5-turbo', 'gpt-4']
+# 各模型的上下文窗口大小（token），可在 model_context.json 中覆盖或补充
+DEFAULT_MODEL_CONTEXT_LIMITS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+DEFAULT_CONTEXT_LIMIT = 8192
 DEFAULT_VOICE = 'onyx'
 VALID_VOICES = {'alloy', 'echo', 'fable', 'nova', 'shimmer', 'onyx'}
+TELEGRAM_MESSAGE_LIMIT = 4096
+TTS_INPUT_LIMIT = 4096
+SENTENCE_END_PATTERN = re.compile(r'[。！？!?；\n]|\.\s')
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -25,16 +77,760 @@ class Config:
     OPENAI_API_KEY: str = os.getenv('OPENAI_API_KEY', '')
     OPENAI_BASE_URL: str = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
     ADMIN_ID: int = int(os.getenv('ADMIN_ID', '0'))
+    # 并发控制：同时进行的OpenAI请求总数、单个用户的并发请求数、同时处理的Telegram更新数
+    OPENAI_MAX_CONCURRENCY: int = int(os.getenv('OPENAI_MAX_CONCURRENCY', '32'))
+    OPENAI_MAX_CONCURRENCY_PER_USER: int = int(os.getenv('OPENAI_MAX_CONCURRENCY_PER_USER', '2'))
+    CONCURRENT_UPDATES: int = int(os.getenv('CONCURRENT_UPDATES', '64'))
+    # 按延迟自动换模型（两个目标都为0时关闭）：最近 MODEL_SLO_WINDOW 秒内某模型的 p90 延迟超过目标（非流式为完整回答的耗时，
+    # 流式为第一段内容的耗时），或者没有可用的上游（熔断、429）时，改用 MODELS 中满足目标的更快的模型并提示用户；
+    # 至少有 MODEL_SLO_MIN_SAMPLES 个样本才判断
+    MODEL_SLO_CHAT: float = float(os.getenv('MODEL_SLO_CHAT', '0'))
+    MODEL_SLO_FIRST_TOKEN: float = float(os.getenv('MODEL_SLO_FIRST_TOKEN', '0'))
+    MODEL_SLO_WINDOW: float = float(os.getenv('MODEL_SLO_WINDOW', '300'))
+    MODEL_SLO_MIN_SAMPLES: int = int(os.getenv('MODEL_SLO_MIN_SAMPLES', '5'))
+    # Webhook模式：设置 WEBHOOK_URL（公网可访问的地址）后使用webhook代替轮询
+    WEBHOOK_URL: str = os.getenv('WEBHOOK_URL', '')
+    WEBHOOK_LISTEN: str = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT: int = int(os.getenv('WEBHOOK_PORT', '8443'))
+    WEBHOOK_PATH: str = os.getenv('WEBHOOK_PATH', 'telegram')
+    WEBHOOK_SECRET: str = os.getenv('WEBHOOK_SECRET', '')
+    # 流式输出时两次编辑消息的最小间隔（秒），群组的编辑频率限制更严格
+    STREAM_EDIT_INTERVAL: float = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+    STREAM_GROUP_EDIT_INTERVAL: float = float(os.getenv('STREAM_GROUP_EDIT_INTERVAL', '3.0'))
+    # 上下文管理：为回答预留的token数；超出上下文窗口的旧消息是否在后台总结，以及总结使用的模型（为空则使用当前模型）
+    RESPONSE_TOKEN_RESERVE: int = int(os.getenv('RESPONSE_TOKEN_RESERVE', '1024'))
+    CONTEXT_SUMMARIZE: bool = os.getenv('CONTEXT_SUMMARIZE', 'true').lower() == 'true'
+    CONTEXT_SUMMARY_MODEL: str = os.getenv('CONTEXT_SUMMARY_MODEL', '')
+    # 会话存储：内存中最多保留的会话数、会话过期时间（秒）、内存上限（MB）；SESSION_DB 非空时持久化到该SQLite文件
+    SESSION_MAX_COUNT: int = int(os.getenv('SESSION_MAX_COUNT', '10000'))
+    SESSION_TTL: float = float(os.getenv('SESSION_TTL', '86400'))
+    SESSION_MAX_MEMORY_MB: float = float(os.getenv('SESSION_MAX_MEMORY_MB', '256'))
+    SESSION_DB: str = os.getenv('SESSION_DB', '')
+    # 用户设置落盘：修改后延迟多少秒批量写入日志，日志累计多少条后重写快照
+    SETTINGS_FLUSH_DELAY: float = float(os.getenv('SETTINGS_FLUSH_DELAY', '1.0'))
+    SETTINGS_COMPACT_THRESHOLD: int = int(os.getenv('SETTINGS_COMPACT_THRESHOLD', '1000'))
+    # 回答缓存（默认关闭）：相同模型和相同消息直接返回缓存的回答
+    RESPONSE_CACHE_ENABLED: bool = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    RESPONSE_CACHE_SIZE: int = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+    RESPONSE_CACHE_TTL: float = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+    # 语音回复按句子分段合成，每段至少包含的字符数
+    TTS_CHUNK_CHARS: int = int(os.getenv('TTS_CHUNK_CHARS', '300'))
+    # 音频在内存中缓冲的上限（字节），超过后转存到临时文件
+    AUDIO_MEMORY_LIMIT: int = int(os.getenv('AUDIO_MEMORY_LIMIT', str(10 * 1024 * 1024)))
+    # 准入控制：格式为"次数/秒数"，例如 20/60 表示每60秒最多20次（允许突发20次），留空或0表示不限制
+    RATE_LIMIT_CHAT_USER: str = os.getenv('RATE_LIMIT_CHAT_USER', '20/60')
+    RATE_LIMIT_CHAT_CHAT: str = os.getenv('RATE_LIMIT_CHAT_CHAT', '60/60')
+    RATE_LIMIT_CHAT_GLOBAL: str = os.getenv('RATE_LIMIT_CHAT_GLOBAL', '600/60')
+    RATE_LIMIT_IMAGE_USER: str = os.getenv('RATE_LIMIT_IMAGE_USER', '5/300')
+    RATE_LIMIT_IMAGE_CHAT: str = os.getenv('RATE_LIMIT_IMAGE_CHAT', '10/300')
+    RATE_LIMIT_IMAGE_GLOBAL: str = os.getenv('RATE_LIMIT_IMAGE_GLOBAL', '60/60')
+    RATE_LIMIT_AUDIO_USER: str = os.getenv('RATE_LIMIT_AUDIO_USER', '20/60')
+    RATE_LIMIT_AUDIO_CHAT: str = os.getenv('RATE_LIMIT_AUDIO_CHAT', '60/60')
+    RATE_LIMIT_AUDIO_GLOBAL: str = os.getenv('RATE_LIMIT_AUDIO_GLOBAL', '300/60')
+    # 同一会话收到新消息时，取消该会话中仍在进行的生成
+    CANCEL_ON_NEW_MESSAGE: bool = os.getenv('CANCEL_ON_NEW_MESSAGE', 'false').lower() == 'true'
+    # 请求排队等待的最长时间（秒），超过则直接拒绝
+    ADMISSION_MAX_WAIT: float = float(os.getenv('ADMISSION_MAX_WAIT', '10'))
+    # 指标：METRICS_PORT 非0时在本地提供 Prometheus 格式的 /metrics
+    METRICS_HOST: str = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT: int = int(os.getenv('METRICS_PORT', '0'))
+    # OpenAI连接池：所有请求共用的长连接数量
+    OPENAI_POOL_SIZE: int = int(os.getenv('OPENAI_POOL_SIZE', '100'))
+    # 各类请求的超时（秒）：建立连接、普通对话、流式输出中两段内容之间的间隔、语音、绘图
+    OPENAI_CONNECT_TIMEOUT: float = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+    OPENAI_CHAT_TIMEOUT: float = float(os.getenv('OPENAI_CHAT_TIMEOUT', '120'))
+    OPENAI_STREAM_TIMEOUT: float = float(os.getenv('OPENAI_STREAM_TIMEOUT', '30'))
+    OPENAI_AUDIO_TIMEOUT: float = float(os.getenv('OPENAI_AUDIO_TIMEOUT', '60'))
+    OPENAI_IMAGE_TIMEOUT: float = float(os.getenv('OPENAI_IMAGE_TIMEOUT', '180'))
+    # 遇到429/5xx或连接错误时的重试次数，以及退避的基础间隔和最长等待（秒）
+    OPENAI_MAX_RETRIES: int = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+    OPENAI_RETRY_BASE_DELAY: float = float(os.getenv('OPENAI_RETRY_BASE_DELAY', '0.5'))
+    OPENAI_RETRY_MAX_DELAY: float = float(os.getenv('OPENAI_RETRY_MAX_DELAY', '30'))
+    # 对冲请求：非流式请求超过 OPENAI_HEDGE_DELAY 秒仍未完成时，向备用地址/密钥再发一次，取先返回的结果（0为关闭）
+    OPENAI_HEDGE_DELAY: float = float(os.getenv('OPENAI_HEDGE_DELAY', '0'))
+    OPENAI_HEDGE_BASE_URL: str = os.getenv('OPENAI_HEDGE_BASE_URL', '')
+    OPENAI_HEDGE_API_KEY: str = os.getenv('OPENAI_HEDGE_API_KEY', '')
+    # 熔断：上游连续失败 CIRCUIT_FAILURE_THRESHOLD 次后，CIRCUIT_OPEN_SECONDS 秒内不再使用
+    CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+    CIRCUIT_OPEN_SECONDS: float = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+    # 绘图任务：同时生成的任务数、最多排队的任务数、单次最多生成的图片数、进度更新间隔（秒）
+    DRAW_WORKERS: int = int(os.getenv('DRAW_WORKERS', '4'))
+    DRAW_QUEUE_SIZE: int = int(os.getenv('DRAW_QUEUE_SIZE', '50'))
+    DRAW_MAX_IMAGES: int = int(os.getenv('DRAW_MAX_IMAGES', '4'))
+    DRAW_PROGRESS_INTERVAL: float = float(os.getenv('DRAW_PROGRESS_INTERVAL', '5'))
+    # 群聊上下文（需在群中用 /group_context on 开启）：每个群最多保留的消息条数、每条消息保留的字符数、
+    # 保留时间（秒）、作为上下文使用的最大token数
+    GROUP_CONTEXT_MAX_MESSAGES: int = int(os.getenv('GROUP_CONTEXT_MAX_MESSAGES', '200'))
+    GROUP_CONTEXT_DEFAULT_MESSAGES: int = int(os.getenv('GROUP_CONTEXT_DEFAULT_MESSAGES', '50'))
+    GROUP_CONTEXT_MAX_CHARS: int = int(os.getenv('GROUP_CONTEXT_MAX_CHARS', '500'))
+    GROUP_CONTEXT_RETENTION: float = float(os.getenv('GROUP_CONTEXT_RETENTION', '21600'))
+    GROUP_CONTEXT_MAX_TOKENS: int = int(os.getenv('GROUP_CONTEXT_MAX_TOKENS', '1000'))
+    # /redo 预取（默认关闭）：最近 REDO_PREFETCH_USER_WINDOW 秒内用过 /redo 的用户，每次回答后在后台预先生成一个备选回答；
+    # 同时最多进行 REDO_PREFETCH_MAX_INFLIGHT 个预取，所有预取每小时最多消耗 REDO_PREFETCH_HOURLY_TOKENS 个token
+    REDO_PREFETCH: bool = os.getenv('REDO_PREFETCH', 'false').lower() == 'true'
+    REDO_PREFETCH_USER_WINDOW: float = float(os.getenv('REDO_PREFETCH_USER_WINDOW', '86400'))
+    REDO_PREFETCH_MAX_INFLIGHT: int = int(os.getenv('REDO_PREFETCH_MAX_INFLIGHT', '4'))
+    REDO_PREFETCH_HOURLY_TOKENS: int = int(os.getenv('REDO_PREFETCH_HOURLY_TOKENS', '200000'))
+    # 多进程部署：SHARED_STATE_URL 为 sqlite:///相对路径、sqlite:////绝对路径（同一台机器上的多个进程）或 redis://...（需安装redis），
+    # 留空表示单进程。WORKER_COUNT>1 时每个聊天固定由第 聊天ID % WORKER_COUNT 号进程处理，其他进程收到的更新会转发给它
+    SHARED_STATE_URL: str = os.getenv('SHARED_STATE_URL', '')
+    WORKER_ID: int = int(os.getenv('WORKER_ID', '0'))
+    WORKER_COUNT: int = int(os.getenv('WORKER_COUNT', '1'))
+    # SQLite共享存储检查新通知和转发的更新的间隔（秒）
+    SHARED_STATE_POLL_INTERVAL: float = float(os.getenv('SHARED_STATE_POLL_INTERVAL', '0.1'))
 
     @classmethod
     def validate(cls):
         if not cls.TOKEN or not cls.OPENAI_API_KEY or cls.ADMIN_ID == 0:
             raise ValueError("请确保设置了所有必要的环境变量：TELEGRAM_BOT_TOKEN, OPENAI_API_KEY, ADMIN_ID")
+        if cls.WORKER_COUNT > 1 and not cls.SHARED_STATE_URL:
+            raise ValueError("WORKER_COUNT 大于1时需要设置 SHARED_STATE_URL")
+        if not 0 <= cls.WORKER_ID < cls.WORKER_COUNT:
+            raise ValueError("WORKER_ID 必须在 0 到 WORKER_COUNT-1 之间")
+
+# 指标：Prometheus文本格式的计数器、仪表和直方图
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ''
+    escaped = (k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+# 计数器：只增不减，也可以在采集时调用回调函数读取已有的累计值
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, LabelKey, float]]:
+        if self.func is not None:
+            yield self.name, (), self.func()
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+# 仪表：可以直接设置，也可以在采集时调用回调函数取值
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: Any) -> None:
+        self.values[tuple(sorted((k, str(v)) for k, v in labels.items()))] = value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # labels -> [各桶计数, 总和, 总数]
+        self.values: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels: Any):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    # 根据桶的上界估算分位数
+    def quantile(self, q: float, key: LabelKey) -> float:
+        counts, _, total = self.values[key]
+        for bound, count in zip(self.buckets, counts):
+            if count >= q * total:
+                return bound
+        return float('inf')
+
+    def samples(self) -> Iterator[Tuple[str, LabelKey, float]]:
+        for key, (counts, total_sum, total) in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', key + (('le', str(bound)),), count
+            yield f'{self.name}_bucket', key + (('le', '+Inf'),), total
+            yield f'{self.name}_sum', key, total_sum
+            yield f'{self.name}_count', key, total
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+
+    # 同名指标的回调函数会被替换（例如重新构建 Application 时）
+    def _register(self, cls: type, name: str, help_text: str, func: Optional[Callable[[], float]]) -> Any:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help_text, func)
+        elif func is not None:
+            metric.func = func
+        return metric
+
+    def counter(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None) -> Counter:
+        return self._register(Counter, name, help_text, func)
+
+    def gauge(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge, name, help_text, func)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+STARTED_AT = time.time()
+stage_latency = metrics.histogram('bot_stage_duration_seconds', '各处理阶段的耗时（Telegram下载、Whisper、对话补全、TTS等）')
+telegram_latency = metrics.histogram('telegram_request_duration_seconds', '调用Telegram Bot API的耗时')
+first_token_latency = metrics.histogram('stream_first_visible_token_seconds', '流式输出中从收到消息到用户看到第一段回答的耗时')
+tokens_total = metrics.counter('openai_tokens_total', '各模型消耗的token数')
+errors_total = metrics.counter('bot_errors_total', '按位置和类型统计的错误数')
+
+def record_error(where: str, error: BaseException) -> None:
+    errors_total.inc(where=where, type=type(error).__name__)
+    logger.warning('%s 出错: %r', where, error, exc_info=error)
+
+def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    tokens_total.inc(prompt_tokens, model=model, type='prompt')
+    tokens_total.inc(completion_tokens, model=model, type='completion')
+
+# OpenAI客户端：多个上游共用一个长连接池，按请求类型设置超时，自行处理路由、重试和对冲请求
+OPENAI_ENDPOINTS = ('chat', 'stream', 'audio', 'image')
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+openai_retries = metrics.counter('openai_retries_total', 'OpenAI请求的重试次数')
+openai_hedges = metrics.counter('openai_hedged_requests_total', '发出的对冲请求数（按先返回的一方统计）')
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def is_retryable(error: Exception) -> bool:
+    import openai
+    if isinstance(error, openai.APIConnectionError):  # 包括超时
+        return True
+    if isinstance(error, openai.APIStatusError):
+        # 额度用尽的429重试也没有用
+        return error.status_code in RETRYABLE_STATUS and getattr(error, 'code', None) != 'insufficient_quota'
+    return False
+
+def is_upstream_fault(error: Exception) -> bool:
+    import openai
+    # 除了可重试的错误，密钥失效或额度用尽也说明是这个上游的问题，换一个上游可能成功
+    if is_retryable(error):
+        return True
+    return isinstance(error, openai.APIStatusError) and (
+        error.status_code in (401, 403) or getattr(error, 'code', None) == 'insufficient_quota'
+    )
 
-Config.validate()
+class NoUpstreamAvailable(Exception):
+    pass
 
-# OpenAI客户端初始化
-client = OpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL)
+upstream_requests = metrics.counter('openai_upstream_requests_total', '发往各上游的请求数（按结果统计）')
+upstream_outstanding = metrics.gauge('openai_upstream_outstanding', '各上游正在进行的请求数')
+upstream_circuit_open = metrics.gauge('openai_upstream_circuit_open', '各上游是否处于熔断状态')
+
+# 一个OpenAI兼容的上游（地址+密钥）：记录进行中的请求数，并根据请求结果做被动健康检查和熔断
+class Upstream:
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float, models: Optional[list], http_client: httpx.AsyncClient, timeouts: Dict[str, float], uses_default_key: bool = False):
+        self.name = name
+        # 没有单独配置密钥、使用 OPENAI_API_KEY 的上游，/set_api_key 省略名称时一起更换
+        self.uses_default_key = uses_default_key
+        self.base_url = base_url
+        self.weight = weight
+        # None 表示该上游支持所有模型
+        self.models: Optional[Set[str]] = set(models) if models else None
+        self.http_client = http_client
+        self.timeouts = timeouts
+        self.outstanding = 0
+        self.failures = 0
+        # 熔断到期时间，0表示未熔断
+        self.open_until = 0.0
+        self.probing = False
+        self.set_api_key(api_key)
+
+    def set_api_key(self, api_key: str) -> None:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key=api_key, base_url=self.base_url, http_client=self.http_client, max_retries=0)
+        self.clients = {
+            endpoint: client.with_options(timeout=httpx.Timeout(timeout, connect=Config.OPENAI_CONNECT_TIMEOUT))
+            for endpoint, timeout in self.timeouts.items()
+        }
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    # 熔断期间不接收请求；到期后只放行一个试探请求，成功则恢复
+    def available(self, now: float) -> bool:
+        if not self.open_until:
+            return True
+        return now >= self.open_until and not self.probing
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        upstream_circuit_open.set(0, upstream=self.name)
+
+    def record_failure(self, cooldown: Optional[float] = None) -> None:
+        self.failures += 1
+        self.probing = False
+        now = time.monotonic()
+        if self.failures >= Config.CIRCUIT_FAILURE_THRESHOLD:
+            self.open_until = now + Config.CIRCUIT_OPEN_SECONDS
+        # 429 带有 Retry-After 时，在这段时间内不再向该上游发请求
+        if cooldown:
+            self.open_until = max(self.open_until, now + cooldown)
+        if self.open_until > now:
+            upstream_circuit_open.set(1, upstream=self.name)
+
+class OpenAIClients:
+    def __init__(self, upstreams_config: list):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=Config.OPENAI_POOL_SIZE, max_keepalive_connections=Config.OPENAI_POOL_SIZE, keepalive_expiry=60),
+        )
+        self.timeouts = {
+            'chat': Config.OPENAI_CHAT_TIMEOUT,
+            'stream': Config.OPENAI_STREAM_TIMEOUT,
+            'audio': Config.OPENAI_AUDIO_TIMEOUT,
+            'image': Config.OPENAI_IMAGE_TIMEOUT,
+        }
+        self.hedge_enabled = Config.OPENAI_HEDGE_DELAY > 0
+        upstreams_config = list(upstreams_config) or [{'name': 'default', 'base_url': Config.OPENAI_BASE_URL}]
+        # 单独配置的对冲地址/密钥作为权重为0的上游：只用于对冲请求和其他上游都不可用时
+        if Config.OPENAI_HEDGE_BASE_URL or Config.OPENAI_HEDGE_API_KEY:
+            upstreams_config.append({
+                'name': 'hedge',
+                'base_url': Config.OPENAI_HEDGE_BASE_URL or Config.OPENAI_BASE_URL,
+                'api_key': Config.OPENAI_HEDGE_API_KEY,
+                'weight': 0,
+            })
+        self.upstreams = [
+            Upstream(
+                item.get('name') or f'upstream{i}',
+                item.get('base_url') or Config.OPENAI_BASE_URL,
+                item.get('api_key') or Config.OPENAI_API_KEY,
+                float(item.get('weight', 1)),
+                item.get('models'),
+                self.http_client,
+                self.timeouts,
+                uses_default_key=not item.get('api_key'),
+            )
+            for i, item in enumerate(upstreams_config)
+        ]
+
+    # 换密钥只替换客户端对象：进行中的请求继续使用旧客户端，连接池不受影响
+    # 省略名称时更换默认密钥：第一个上游和所有使用 OPENAI_API_KEY 的上游（包括对冲上游）
+    def set_api_key(self, api_key: str, name: Optional[str] = None) -> bool:
+        if name is None:
+            for i, upstream in enumerate(self.upstreams):
+                if i == 0 or upstream.uses_default_key:
+                    upstream.set_api_key(api_key)
+                    upstream.uses_default_key = True
+            return True
+        for upstream in self.upstreams:
+            if upstream.name == name:
+                upstream.set_api_key(api_key)
+                upstream.uses_default_key = False
+                return True
+        return False
+
+    # 加权最少连接：在可用的上游中选 (进行中的请求数+1)/权重 最小的一个
+    def pick(self, model: str, exclude: Set[Upstream] = frozenset()) -> Upstream:
+        now = time.monotonic()
+        serving = [u for u in self.upstreams if u.serves(model) and u.available(now)]
+        # 优先没试过的常规上游，其次没试过的备用上游（权重为0），最后才回到试过的上游
+        candidates = (
+            [u for u in serving if u.weight > 0 and u not in exclude]
+            or [u for u in serving if u not in exclude]
+            or [u for u in serving if u.weight > 0]
+            or serving
+        )
+        if not candidates:
+            raise NoUpstreamAvailable(f'没有可用的上游支持模型 {model}')
+        upstream = min(candidates, key=lambda u: ((u.outstanding + 1) / (u.weight or 1), random.random()))
+        if upstream.open_until:
+            upstream.probing = True
+        return upstream
+
+    def has_alternative(self, model: str, tried: Set[Upstream]) -> bool:
+        now = time.monotonic()
+        return any(u.serves(model) and u.available(now) and u not in tried for u in self.upstreams)
+
+    # 对冲请求优先发往另一个上游，没有时发往同一个上游（使用新的连接）
+    def pick_hedge(self, model: str, primary: Upstream) -> Upstream:
+        now = time.monotonic()
+        others = [u for u in self.upstreams if u is not primary and u.serves(model) and u.available(now)]
+        if not others:
+            return primary
+        upstream = min(others, key=lambda u: (u.outstanding, random.random()))
+        if upstream.open_until:
+            upstream.probing = True
+        return upstream
+
+    # func 接收一个 AsyncOpenAI 客户端并发起请求；失败时换上游或按退避重试，hedge=True 时允许发出对冲请求
+    async def request(self, endpoint: str, model: str, func: Callable[['AsyncOpenAI'], Awaitable[Any]], hedge: bool = True) -> Any:
+        attempt = 0
+        tried: Set[Upstream] = set()
+        while True:
+            upstream = self.pick(model, tried)
+            tried.add(upstream)
+            try:
+                if hedge and self.hedge_enabled:
+                    return await self._hedged(endpoint, model, upstream, func)
+                return await self._call(upstream, endpoint, func)
+            except Exception as e:
+                alternative = self.has_alternative(model, tried)
+                if attempt >= Config.OPENAI_MAX_RETRIES or not (is_retryable(e) or (alternative and is_upstream_fault(e))):
+                    raise
+                attempt += 1
+                openai_retries.inc(endpoint=endpoint, reason=getattr(e, 'status_code', None) or type(e).__name__)
+                if alternative:
+                    # 还有没试过的上游，立即换一个
+                    logger.info('OpenAI %s 请求在上游 %s 失败（%r），换一个上游重试', endpoint, upstream.name, e)
+                    continue
+                delay = random.uniform(0, min(Config.OPENAI_RETRY_MAX_DELAY, Config.OPENAI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    if retry_after > Config.OPENAI_RETRY_MAX_DELAY:
+                        raise
+                    delay = retry_after + delay / 2
+                logger.info('OpenAI %s 请求失败（%r），%.2f 秒后第 %d 次重试', endpoint, e, delay, attempt)
+                await asyncio.sleep(delay)
+                tried.clear()
+
+    # 流式请求只统计到响应头返回为止，之后读取内容期间不计入进行中的请求数
+    async def _call(self, upstream: Upstream, endpoint: str, func: Callable[['AsyncOpenAI'], Awaitable[Any]]) -> Any:
+        upstream.outstanding += 1
+        upstream_outstanding.set(upstream.outstanding, upstream=upstream.name)
+        try:
+            result = await func(upstream.clients[endpoint])
+        except asyncio.CancelledError:
+            upstream.probing = False
+            raise
+        except Exception as e:
+            if is_upstream_fault(e):
+                upstream.record_failure(get_retry_after(e) if getattr(e, 'status_code', None) == 429 else None)
+            else:
+                upstream.probing = False
+            upstream_requests.inc(upstream=upstream.name, result='error')
+            raise
+        finally:
+            upstream.outstanding -= 1
+            upstream_outstanding.set(upstream.outstanding, upstream=upstream.name)
+        upstream.record_success()
+        upstream_requests.inc(upstream=upstream.name, result='ok')
+        return result
+
+    async def _hedged(self, endpoint: str, model: str, upstream: Upstream, func: Callable[['AsyncOpenAI'], Awaitable[Any]]) -> Any:
+        primary = asyncio.ensure_future(self._call(upstream, endpoint, func))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=Config.OPENAI_HEDGE_DELAY)
+            if not done:
+                tasks.append(asyncio.ensure_future(self._call(self.pick_hedge(model, upstream), endpoint, func)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            openai_hedges.inc(endpoint=endpoint, winner='primary' if task is primary else 'hedge')
+                        return task.result()
+            # 两个请求都失败了，以主请求的错误为准
+            raise primary.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+# 等待全局并发名额时的优先级（数字越小越优先）：管理员 > 白名单用户的私聊 > 群组 > 后台任务（摘要、/redo 预取）
+PRIORITY_ADMIN, PRIORITY_PRIVATE, PRIORITY_GROUP, PRIORITY_BACKGROUND = range(4)
+PRIORITY_NAMES = ('admin', 'private', 'group', 'background')
+
+def request_priority(user_id: int, chat_id: int) -> int:
+    if user_id == Config.ADMIN_ID:
+        return PRIORITY_ADMIN
+    if chat_id > 0 and user_id in allowed_users:
+        return PRIORITY_PRIVATE
+    return PRIORITY_GROUP
+
+openai_queue_wait = metrics.histogram('openai_queue_wait_seconds', '等待OpenAI全局并发名额的耗时（按优先级）')
+
+# OpenAI并发限制：全局上限 + 每个用户的上限；全局名额空出时交给优先级最高、到达最早的等待者
+class ConcurrencyLimiter:
+    def __init__(self, global_limit: int, per_user_limit: int):
+        self.per_user_limit = per_user_limit
+        self._available = global_limit
+        # (优先级, 到达顺序, future)，被取消的等待者留在堆中，出堆时跳过
+        self._queue: list = []
+        self._sequence = itertools.count()
+        self._users: Dict[int, asyncio.Semaphore] = {}
+        self._user_refs: Dict[int, int] = {}
+        self.waiting = 0
+        self.active = 0
+
+    async def _acquire(self, priority: int) -> None:
+        while self._queue and self._queue[0][2].done():
+            heapq.heappop(self._queue)
+        if self._available > 0 and not self._queue:
+            self._available -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 名额已经交给了这个等待者，但它同时被取消了：转交给下一个
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._available += 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, priority: int = PRIORITY_GROUP):
+        semaphore = self._users.get(user_id)
+        if semaphore is None:
+            semaphore = self._users[user_id] = asyncio.Semaphore(self.per_user_limit)
+        self._user_refs[user_id] = self._user_refs.get(user_id, 0) + 1
+        self.waiting += 1
+        try:
+            async with semaphore:
+                with openai_queue_wait.time(priority=PRIORITY_NAMES[priority]):
+                    await self._acquire(priority)
+                self.waiting -= 1
+                self.active += 1
+                try:
+                    yield
+                finally:
+                    self.active -= 1
+                    self.waiting += 1
+                    self._release()
+        finally:
+            self.waiting -= 1
+            # 没有等待者时回收该用户的信号量，防止字典无限增长
+            self._user_refs[user_id] -= 1
+            if self._user_refs[user_id] == 0:
+                del self._user_refs[user_id]
+                del self._users[user_id]
+
+openai_limiter = ConcurrencyLimiter(Config.OPENAI_MAX_CONCURRENCY, Config.OPENAI_MAX_CONCURRENCY_PER_USER)
+metrics.gauge('openai_requests_waiting', '等待并发名额的OpenAI请求数', lambda: openai_limiter.waiting)
+metrics.gauge('openai_requests_active', '正在进行的OpenAI请求数', lambda: openai_limiter.active)
+
+model_fallbacks = metrics.counter('model_fallbacks_total', '因延迟超过目标或没有可用上游而改用其他模型的次数')
+
+# 按模型记录最近的延迟，模型超过延迟目标或者没有可用上游时选一个替代的模型
+class ModelFallback:
+    def __init__(self, slos: Dict[str, float], window: float, min_samples: int):
+        # 'chat'：非流式完整回答的耗时，'first_token'：流式第一段内容的耗时；0表示不检查
+        self.slos = {kind: slo for kind, slo in slos.items() if slo > 0}
+        self.enabled = bool(self.slos)
+        self.window = window
+        self.min_samples = min_samples
+        # (模型, 类型) -> (时间, 延迟)
+        self._samples: Dict[Tuple[str, str], deque] = {}
+
+    def record(self, model: str, kind: str, seconds: float) -> None:
+        if kind not in self.slos:
+            return
+        samples = self._samples.get((model, kind))
+        if samples is None:
+            samples = self._samples[(model, kind)] = deque(maxlen=200)
+        samples.append((time.monotonic(), seconds))
+
+    # 窗口内的 p90 延迟，样本不足时返回None
+    def p90(self, model: str, kind: str, min_samples: int) -> Optional[float]:
+        samples = self._samples.get((model, kind))
+        if samples is None:
+            return None
+        cutoff = time.monotonic() - self.window
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        if len(samples) < max(min_samples, 1):
+            return None
+        latencies = sorted(latency for _, latency in samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+
+    async def breached(self, model: str) -> bool:
+        if not (await get_openai_clients_async()).has_alternative(model, set()):
+            return True
+        for kind, slo in self.slos.items():
+            p90 = self.p90(model, kind, self.min_samples)
+            if p90 is not None and p90 > slo:
+                return True
+        return False
+
+    # 返回本次实际使用的模型：原模型正常时不变；否则优先选最近延迟最低的模型，没有样本的模型按 MODELS 中的顺序排在后面
+    async def choose(self, model: str) -> str:
+        if not self.enabled or not await self.breached(model):
+            return model
+        candidates = [m for m in MODELS if m != model and not await self.breached(m)]
+        if not candidates:
+            return model
+
+        def recent_latency(candidate: str) -> float:
+            latencies = [self.p90(candidate, kind, 1) for kind in self.slos]
+            known = [latency for latency in latencies if latency is not None]
+            return max(known) if known else float('inf')
+
+        fallback = min(candidates, key=recent_latency)
+        model_fallbacks.inc(model=model, fallback=fallback)
+        return fallback
+
+model_fallback = ModelFallback({'chat': Config.MODEL_SLO_CHAT, 'first_token': Config.MODEL_SLO_FIRST_TOKEN}, Config.MODEL_SLO_WINDOW, Config.MODEL_SLO_MIN_SAMPLES)
+
+async def notify_fallback(update: Update, requested: str, used: str) -> None:
+    if used != requested:
+        await update.message.reply_text(f'{requested} 当前响应较慢或暂时不可用，本次回答改用了 {used}。')
+
+# 令牌桶：每秒补充rate个令牌，最多capacity个；令牌可以被预约成负数，后到的请求等待更久，从而按到达顺序排队
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def parse_rate_limit(spec: str) -> Optional[Tuple[float, float]]:
+    if not spec or spec == '0':
+        return None
+    count, seconds = spec.split('/')
+    return float(count) / float(seconds), float(count)
+
+ADMISSION_KINDS = ('chat', 'image', 'audio')
+ADMISSION_SCOPES = ('user', 'chat', 'global')
+
+# 准入控制：按请求类型（对话/图像/语音）分别限制每个用户、每个聊天和全局的请求速率；
+# 需要等待的请求在令牌桶中排队，预计等待超过 ADMISSION_MAX_WAIT 的请求立即拒绝
+class AdmissionController:
+    def __init__(self, limits: Dict[Tuple[str, str], Optional[Tuple[float, float]]], max_wait: float):
+        self.limits = limits
+        self.max_wait = max_wait
+        self._buckets: Dict[Tuple[str, str, int], TokenBucket] = {}
+        self.admitted: Dict[str, int] = {kind: 0 for kind in ADMISSION_KINDS}
+        self.rejected: Dict[str, int] = {kind: 0 for kind in ADMISSION_KINDS}
+        self.queued = 0
+
+    def _bucket(self, kind: str, scope: str, key: int) -> Optional[TokenBucket]:
+        limit = self.limits.get((kind, scope))
+        if limit is None:
+            return None
+        bucket = self._buckets.get((kind, scope, key))
+        if bucket is None:
+            bucket = self._buckets[(kind, scope, key)] = TokenBucket(*limit)
+        return bucket
+
+    async def admit(self, kind: str, user_id: int, chat_id: int) -> bool:
+        now = time.monotonic()
+        buckets = [self._bucket(kind, 'user', user_id), self._bucket(kind, 'global', 0)]
+        if chat_id != user_id:
+            buckets.append(self._bucket(kind, 'chat', chat_id))
+        buckets = [bucket for bucket in buckets if bucket is not None]
+        wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+        if wait > self.max_wait:
+            self.rejected[kind] += 1
+            admission_rejected.inc(kind=kind)
+            return False
+        for bucket in buckets:
+            bucket.reserve(now)
+        self.admitted[kind] += 1
+        if len(self._buckets) > 10000:
+            self._cleanup(now)
+        if wait > 0:
+            self.queued += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.queued -= 1
+        return True
+
+    # 删除已经补满的令牌桶，避免字典无限增长
+    def _cleanup(self, now: float) -> None:
+        for key in [key for key, bucket in self._buckets.items() if key[1] != 'global' and bucket.is_idle(now)]:
+            del self._buckets[key]
+
+admission = AdmissionController(
+    {(kind, scope): parse_rate_limit(getattr(Config, f'RATE_LIMIT_{kind.upper()}_{scope.upper()}'))
+     for kind in ADMISSION_KINDS for scope in ADMISSION_SCOPES},
+    Config.ADMISSION_MAX_WAIT
+)
+metrics.gauge('admission_queued', '在准入控制中排队等待的请求数', lambda: admission.queued)
+admission_rejected = metrics.counter('admission_rejected_total', '被准入控制拒绝的请求数（按类型）')
+
+async def admit_request(update: Update, *kinds: str) -> bool:
+    for kind in kinds:
+        if not await admission.admit(kind, update.effective_user.id, update.effective_chat.id):
+            await update.message.reply_text('请求过于频繁，请稍后再试。')
+            return False
+    return True
 
 # 文件操作函数
 def load_json(filename: str, default: Any) -> Any:
@@ -50,9 +846,500 @@ def save_json(filename: str, data: Any) -> None:
 
 # 数据加载
 MODELS: list = load_json(MODELS_FILE, DEFAULT_MODELS)
+MODEL_CONTEXT_LIMITS: Dict[str, int] = {**DEFAULT_MODEL_CONTEXT_LIMITS, **load_json(MODEL_CONTEXT_FILE, {})}
 allowed_users: Set[int] = set(load_json(USERS_FILE, []))
-user_settings: Dict[str, Dict[str, Any]] = load_json(USER_SETTINGS_FILE, {})
-user_sessions: Dict[str, list] = {}
+
+# OpenAI客户端在第一次使用时创建（启动后也会在后台线程中预先创建）
+_openai_clients: Optional[OpenAIClients] = None
+_openai_clients_lock = threading.Lock()
+_openai_warmup: Optional[asyncio.Future] = None
+# 管理员通过 /set_api_key 设置的密钥：上游名称 -> 密钥（空名称表示默认密钥），按设置顺序重放，多进程部署时同步给其他进程
+api_key_overrides: Dict[str, str] = {}
+
+def get_openai_clients() -> OpenAIClients:
+    global _openai_clients
+    if _openai_clients is None:
+        with _openai_clients_lock:
+            if _openai_clients is None:
+                clients = OpenAIClients(load_json(UPSTREAMS_FILE, []))
+                for name, api_key in api_key_overrides.items():
+                    clients.set_api_key(api_key, name or None)
+                _openai_clients = clients
+    return _openai_clients
+
+# 在后台线程中创建OpenAI客户端，返回可以等待的Future；已有进行中的预热时直接返回它
+def start_openai_warmup() -> asyncio.Future:
+    global _openai_warmup
+    if _openai_warmup is None or _openai_warmup.done():
+        _openai_warmup = asyncio.ensure_future(asyncio.to_thread(get_openai_clients))
+    return _openai_warmup
+
+# 协程中使用：客户端还没创建好时等待后台预热，不在事件循环上持锁等待导入openai，其他更新照常处理
+async def get_openai_clients_async() -> OpenAIClients:
+    if _openai_clients is not None:
+        return _openai_clients
+    # shield：等待的请求被取消时不取消预热本身
+    return await asyncio.shield(start_openai_warmup())
+
+async def openai_request(endpoint: str, model: str, func: Callable[['AsyncOpenAI'], Awaitable[Any]], hedge: bool = True) -> Any:
+    clients = await get_openai_clients_async()
+    return await clients.request(endpoint, model, func, hedge)
+
+# token计数：安装了tiktoken时精确计算，否则按字符粗略估算
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+def get_encoding_name(model: str) -> str:
+    return get_encoding(model).name if tiktoken is not None else 'estimate'
+
+def count_tokens(text: str, model: str) -> int:
+    if tiktoken is not None:
+        return len(get_encoding(model).encode(text))
+    # 非ASCII字符（如中文）大约每个字符1个token，ASCII大约每4个字符1个token
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return non_ascii + (len(text) - non_ascii) // 4 + 1
+
+def count_message_tokens(message: dict, model: str) -> int:
+    # 每条消息在格式上额外占用约4个token
+    return count_tokens(message['content'] or '', model) + 4
+
+def get_context_budget(model: str) -> int:
+    return MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT) - Config.RESPONSE_TOKEN_RESERVE
+
+# 对话会话：缓存每条消息的token数，超出模型上下文预算时裁剪最旧的消息并在后台总结
+class ChatSession:
+    def __init__(self):
+        self.messages: list = []
+        self.token_counts: list = []
+        self.encoding_name: Optional[str] = None
+        self.total_tokens = 0
+        self.summary: Optional[str] = None
+        self.summary_tokens = 0
+        # 群聊中最近的消息，每次生成前重新获取，不保存
+        self.group_context: Optional[str] = None
+        self._pending_summary: list = []
+        self._summary_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def to_dict(self) -> dict:
+        return {'messages': self.messages, 'summary': self.summary}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ChatSession':
+        session = cls()
+        session.messages = data.get('messages', [])
+        session.token_counts = [None] * len(session.messages)
+        session.summary = data.get('summary')
+        return session
+
+    # 估算会话占用的内存（字节）
+    def memory_size(self) -> int:
+        return 512 + sum(sys.getsizeof(m['content'] or '') + 232 for m in self.messages) + sys.getsizeof(self.summary or '')
+
+    def append(self, role: str, content: str) -> None:
+        self.messages.append({'role': role, 'content': content})
+        self.token_counts.append(None)
+
+    def pop(self) -> dict:
+        count = self.token_counts.pop()
+        if count is not None:
+            self.total_tokens -= count
+        return self.messages.pop()
+
+    def _count(self, model: str) -> None:
+        encoding_name = get_encoding_name(model)
+        if encoding_name != self.encoding_name:
+            # 切换到使用不同编码的模型时重新计数
+            self.encoding_name = encoding_name
+            self.token_counts = [None] * len(self.messages)
+            self.total_tokens = 0
+            self.summary_tokens = count_tokens(self.summary, model) if self.summary else 0
+        for i, count in enumerate(self.token_counts):
+            if count is None:
+                self.token_counts[i] = count_message_tokens(self.messages[i], model)
+                self.total_tokens += self.token_counts[i]
+
+    # 生成发送给模型的消息列表，裁剪结果保存在会话中，不会每轮重新计算
+    def build_prompt(self, model: str, user_id: int) -> list:
+        self._count(model)
+        group_tokens = count_tokens(self.group_context, model) if self.group_context else 0
+        budget = get_context_budget(model) - self.summary_tokens - group_tokens
+        dropped = []
+        while self.total_tokens > budget and len(self.messages) > 1:
+            dropped.append(self.messages.pop(0))
+            self.total_tokens -= self.token_counts.pop(0)
+        if dropped and Config.CONTEXT_SUMMARIZE:
+            self._pending_summary.extend(dropped)
+            if self._summary_task is None or self._summary_task.done():
+                self._summary_task = asyncio.create_task(self._summarize(model, user_id))
+        prompt = []
+        if self.group_context:
+            prompt.append({'role': 'system', 'content': f'群聊中最近的消息：\n{self.group_context}'})
+        if self.summary:
+            prompt.append({'role': 'system', 'content': f'此前对话的摘要：{self.summary}'})
+        return prompt + self.messages
+
+    async def _summarize(self, model: str, user_id: int) -> None:
+        while self._pending_summary:
+            dropped, self._pending_summary = self._pending_summary, []
+            try:
+                summary = await summarize_messages(user_id, Config.CONTEXT_SUMMARY_MODEL or model, self.summary, dropped)
+            except Exception as e:
+                record_error('summarize', e)
+                return
+            self.summary = summary
+            self.summary_tokens = count_tokens(summary, model)
+
+# SQLite会话持久化：每个会话一行JSON，重启后按需加载
+class SQLiteSessionBackend:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)')
+        self._conn.commit()
+
+    def load(self, key: str, ttl: float) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT data, updated FROM sessions WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return json.loads(row[0])
+
+    def save(self, key: str, data: dict) -> None:
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO sessions (key, data, updated) VALUES (?, ?, ?)', (key, payload, time.time()))
+            self._conn.commit()
+
+    def purge(self, ttl: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - ttl,))
+            self._conn.commit()
+        return cursor.rowcount
+
+# 阻塞读取通知和转发队列时每次最多等待的时间（秒）；后台任务每隔这么久检查一次是否需要退出
+SHARED_STATE_BLOCK_TIMEOUT = 1.0
+
+# 多进程共享状态（SQLite实现）：同一台机器上的多个进程共用一个SQLite文件，保存会话、键值和哈希，
+# 并提供变更通知和转发更新用的队列；阻塞调用和 SQLiteSessionBackend 一样在线程中执行
+class SQLiteSharedState(SQLiteSessionBackend):
+    def __init__(self, path: str):
+        super().__init__(path)
+        # field 为空字符串的行保存普通的值
+        self._conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (key, field))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, message TEXT NOT NULL, created REAL NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, item TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS queue_name ON queue (name, id)')
+        self._conn.commit()
+
+    def get(self, key: str) -> Any:
+        return self.get_hash(key).get('')
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_hashes({key: {'': value}})
+
+    def get_hash(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute('SELECT field, value FROM kv WHERE key = ?', (key,)).fetchall()
+        return {field: json.loads(value) for field, value in rows}
+
+    # 在一个事务中写入多个哈希的字段：{key: {field: value}}
+    def set_hashes(self, hashes: Dict[str, Dict[str, Any]]) -> None:
+        rows = [(key, field, json.dumps(value, ensure_ascii=False)) for key, fields in hashes.items() for field, value in fields.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO kv (key, field, value) VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+    def scan_hashes(self, prefix: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute('SELECT key, field, value FROM kv WHERE key >= ? AND key < ?', (prefix, prefix + '\uffff')).fetchall()
+        hashes: Dict[str, Dict[str, Any]] = {}
+        for key, field, value in rows:
+            hashes.setdefault(key, {})[field] = json.loads(value)
+        return hashes
+
+    def publish(self, channel: str, message: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT INTO changes (channel, message, created) VALUES (?, ?, ?)', (channel, json.dumps(message, ensure_ascii=False), now))
+            # 只保留最近一小时的通知
+            self._conn.execute('DELETE FROM changes WHERE created < ?', (now - 3600,))
+            self._conn.commit()
+
+    def latest_cursor(self) -> Any:
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(id), 0) FROM changes').fetchone()[0]
+
+    # 返回 (新的位置, cursor之后的通知列表)，没有新通知时最多等待timeout秒
+    def poll(self, cursor: Any, timeout: float) -> Tuple[Any, list]:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                rows = self._conn.execute('SELECT id, channel, message FROM changes WHERE id > ? ORDER BY id', (cursor,)).fetchall()
+            if rows:
+                return rows[-1][0], [(channel, json.loads(message)) for _, channel, message in rows]
+            if time.monotonic() >= deadline:
+                return cursor, []
+            time.sleep(Config.SHARED_STATE_POLL_INTERVAL)
+
+    # items: [(队列名, 内容)]，按顺序追加
+    def push(self, items: list) -> None:
+        with self._lock:
+            self._conn.executemany('INSERT INTO queue (name, item) VALUES (?, ?)', [(name, json.dumps(item, ensure_ascii=False)) for name, item in items])
+            self._conn.commit()
+
+    # 取出队列中最多limit个内容，队列为空时最多等待timeout秒
+    def pop(self, name: str, timeout: float, limit: int = 100) -> list:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._conn.execute('BEGIN IMMEDIATE')
+                rows = self._conn.execute('SELECT id, item FROM queue WHERE name = ? ORDER BY id LIMIT ?', (name, limit)).fetchall()
+                if rows:
+                    self._conn.execute('DELETE FROM queue WHERE name = ? AND id <= ?', (name, rows[-1][0]))
+                self._conn.commit()
+            if rows:
+                return [json.loads(item) for _, item in rows]
+            if time.monotonic() >= deadline:
+                return []
+            time.sleep(Config.SHARED_STATE_POLL_INTERVAL)
+
+# 多进程共享状态（Redis实现）：接口与 SQLiteSharedState 相同，会话用过期时间淘汰，通知使用Stream，队列使用List
+class RedisSharedState:
+    def __init__(self, url: str, session_ttl: float, prefix: str = 'gpt-bot:'):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.session_ttl = session_ttl
+        self.prefix = prefix
+
+    def load(self, key: str, ttl: float) -> Optional[dict]:
+        value = self._redis.get(f'{self.prefix}session:{key}')
+        return json.loads(value) if value is not None else None
+
+    def save(self, key: str, data: dict) -> None:
+        self._redis.set(f'{self.prefix}session:{key}', json.dumps(data, ensure_ascii=False), ex=max(1, int(self.session_ttl)))
+
+    def purge(self, ttl: float) -> int:
+        return 0  # 由Redis的过期时间淘汰
+
+    def get(self, key: str) -> Any:
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any) -> None:
+        self._redis.set(self.prefix + key, json.dumps(value, ensure_ascii=False))
+
+    def get_hash(self, key: str) -> Dict[str, Any]:
+        return {field: json.loads(value) for field, value in self._redis.hgetall(self.prefix + key).items()}
+
+    def set_hashes(self, hashes: Dict[str, Dict[str, Any]]) -> None:
+        pipeline = self._redis.pipeline()
+        for key, fields in hashes.items():
+            pipeline.hset(self.prefix + key, mapping={field: json.dumps(value, ensure_ascii=False) for field, value in fields.items()})
+        pipeline.execute()
+
+    # 每批扫描到的key用一个pipeline读取，避免每个key一次往返
+    def scan_hashes(self, prefix: str) -> Dict[str, Dict[str, Any]]:
+        hashes: Dict[str, Dict[str, Any]] = {}
+        keys = list(self._redis.scan_iter(match=f'{self.prefix}{prefix}*', count=1000))
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            pipeline = self._redis.pipeline(transaction=False)
+            for key in batch:
+                pipeline.hgetall(key)
+            for key, fields in zip(batch, pipeline.execute()):
+                hashes[key[len(self.prefix):]] = {field: json.loads(value) for field, value in fields.items()}
+        return hashes
+
+    def publish(self, channel: str, message: dict) -> None:
+        self._redis.xadd(f'{self.prefix}changes', {'channel': channel, 'message': json.dumps(message, ensure_ascii=False)}, maxlen=10000, approximate=True)
+
+    def latest_cursor(self) -> Any:
+        entries = self._redis.xrevrange(f'{self.prefix}changes', count=1)
+        return entries[0][0] if entries else '0-0'
+
+    def poll(self, cursor: Any, timeout: float) -> Tuple[Any, list]:
+        result = self._redis.xread({f'{self.prefix}changes': cursor}, block=int(timeout * 1000))
+        if not result:
+            return cursor, []
+        entries = result[0][1]
+        return entries[-1][0], [(fields['channel'], json.loads(fields['message'])) for _, fields in entries]
+
+    def push(self, items: list) -> None:
+        pipeline = self._redis.pipeline()
+        for name, item in items:
+            pipeline.rpush(f'{self.prefix}queue:{name}', json.dumps(item, ensure_ascii=False))
+        pipeline.execute()
+
+    def pop(self, name: str, timeout: float, limit: int = 100) -> list:
+        key = f'{self.prefix}queue:{name}'
+        first = self._redis.blpop(key, timeout=timeout)
+        if first is None:
+            return []
+        rest = self._redis.lpop(key, limit - 1) if limit > 1 else None
+        return [json.loads(item) for item in [first[1], *(rest or [])]]
+
+def create_shared_state() -> Any:
+    url = Config.SHARED_STATE_URL
+    if not url:
+        return None
+    if url.startswith('sqlite:///'):
+        return SQLiteSharedState(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise ValueError('使用Redis作为共享存储需要先安装 redis：pip install redis')
+        return RedisSharedState(url, Config.SESSION_TTL)
+    raise ValueError(f'不支持的 SHARED_STATE_URL: {url}')
+
+shared_state = create_shared_state()
+# 本进程发出的通知带上这个标记，收到时跳过
+WORKER_TOKEN = os.urandom(8).hex()
+
+# 会话存储：按LRU顺序保存在内存中，超过数量/内存上限或过期时淘汰；配置了后端时写穿透持久化并按需加载
+class SessionStore:
+    def __init__(self, max_sessions: int, ttl: float, max_bytes: int, backend: Any = None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.backend = backend
+        # key -> [会话, 最近访问时间, 估算的内存大小]
+        self._entries: 'OrderedDict[str, list]' = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    async def get(self, key: str) -> Optional[ChatSession]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[1] <= self.ttl:
+                entry[1] = time.monotonic()
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._remove(key)
+        if self.backend is None:
+            return None
+        data = await asyncio.to_thread(self.backend.load, key, self.ttl)
+        if data is None:
+            return None
+        session = ChatSession.from_dict(data)
+        self._put(key, session)
+        return session
+
+    def new(self, key: str) -> ChatSession:
+        session = ChatSession()
+        self._put(key, session)
+        return session
+
+    # 会话内容变化后调用：更新内存估算并持久化
+    async def save(self, key: str) -> None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        size = entry[0].memory_size()
+        self.total_bytes += size - entry[2]
+        entry[2] = size
+        self._evict()
+        if self.backend is not None:
+            await asyncio.to_thread(self.backend.save, key, entry[0].to_dict())
+
+    def _put(self, key: str, session: ChatSession) -> None:
+        if key in self._entries:
+            self._remove(key)
+        size = session.memory_size()
+        self._entries[key] = [session, time.monotonic(), size]
+        self.total_bytes += size
+        self._evict()
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry[2]
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_sessions and self.total_bytes <= self.max_bytes and now - entry[1] <= self.ttl:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+class GenerationCancelled(Exception):
+    pass
+
+# 会话锁：同一会话的消息依次处理，不同会话互不阻塞；同一会话的新消息可以取消仍在进行的生成
+class SessionLockManager:
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refs: Dict[str, int] = {}
+        self._generations: Dict[str, asyncio.Task] = {}
+        self._superseded: Set[asyncio.Task] = set()
+        self.cancelled = 0
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                del self._refs[key]
+                del self._locks[key]
+
+    # 在可取消的任务中运行生成，被新消息取消时抛出 GenerationCancelled
+    async def run_generation(self, key: str, coroutine: Awaitable[Any]) -> Any:
+        task = asyncio.ensure_future(coroutine)
+        self._generations[key] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self._superseded:
+                raise GenerationCancelled()
+            raise
+        finally:
+            self._superseded.discard(task)
+            if self._generations.get(key) is task:
+                del self._generations[key]
+
+    def cancel_generation(self, key: str) -> bool:
+        task = self._generations.get(key)
+        if task is None or task.done():
+            return False
+        self._superseded.add(task)
+        task.cancel()
+        self.cancelled += 1
+        return True
+
+session_locks = SessionLockManager()
+
+def create_session_store() -> SessionStore:
+    backend = shared_state
+    if backend is None and Config.SESSION_DB:
+        backend = SQLiteSessionBackend(Config.SESSION_DB)
+    if backend is not None:
+        backend.purge(Config.SESSION_TTL)
+    return SessionStore(Config.SESSION_MAX_COUNT, Config.SESSION_TTL, int(Config.SESSION_MAX_MEMORY_MB * 1024 * 1024), backend)
+
+user_sessions = create_session_store()
+metrics.gauge('session_store_sessions', '内存中的会话数', lambda: len(user_sessions))
+metrics.gauge('session_store_bytes', '会话占用的估算内存（字节）', lambda: user_sessions.total_bytes)
+metrics.counter('session_store_evictions_total', '被淘汰的会话数', lambda: user_sessions.evictions)
+metrics.counter('generations_cancelled_total', '因收到新消息而取消的生成数', lambda: session_locks.cancelled)
 
 # 用户权限检查
 def is_user_allowed(user_id: int, chat_id: int) -> bool:
@@ -62,30 +1349,546 @@ def is_user_allowed(user_id: int, chat_id: int) -> bool:
 def get_session_key(user_id: int, chat_id: int) -> str:
     return f"{user_id}:{chat_id}"
 
-# 用户设置处理
-def get_user_setting(user_id: int, chat_id: int, key: str, default: Any) -> Any:
-    user_id_str = str(user_id)
-    chat_id_str = str(chat_id)
-    if user_id_str in user_settings:
-        if chat_id_str in user_settings[user_id_str].get("chats", {}):
-            return user_settings[user_id_str]["chats"][chat_id_str].get(key, 
-                   user_settings[user_id_str]["global"].get(key, default))
+# 群聊上下文：开启后为每个群保留最近的消息。每个群的容量固定，消息按UTF-8字节存放在环形缓冲区中，
+# 内存占用只取决于开启的群数和容量，与群里的消息量无关
+class GroupHistory:
+    __slots__ = ('entries', 'times', 'message_ids', 'written')
+
+    def __init__(self, capacity: int):
+        self.entries: list = [None] * capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.message_ids = array('q', bytes(8 * capacity))
+        # 已写入的总条数，对容量取模得到下一次写入的槽位
+        self.written = 0
+
+    def add(self, message_id: int, when: float, line: bytes) -> None:
+        slot = self.written % len(self.entries)
+        self.entries[slot] = line
+        self.times[slot] = when
+        self.message_ids[slot] = message_id
+        self.written += 1
+
+    # 从新到旧遍历 since 之后的消息
+    def recent(self, since: float) -> Iterator[Tuple[int, bytes]]:
+        capacity = len(self.entries)
+        for i in range(self.written - 1, max(-1, self.written - 1 - capacity), -1):
+            slot = i % capacity
+            if self.times[slot] < since:
+                return
+            yield self.message_ids[slot], self.entries[slot]
+
+    def memory_size(self) -> int:
+        return sum(len(entry) for entry in self.entries if entry) + len(self.entries) * 24
+
+class GroupContextStore:
+    def __init__(self, filename: str):
+        self.filename = filename
+        # chat_id -> 保留的消息条数，只有开启的群会记录消息
+        self.enabled: Dict[str, int] = load_json(filename, {})
+        self.histories: Dict[int, GroupHistory] = {}
+
+    def capacity(self, chat_id: int) -> int:
+        return self.enabled.get(str(chat_id), 0)
+
+    def enable(self, chat_id: int, capacity: int) -> None:
+        self.enabled[str(chat_id)] = capacity
+        self.histories.pop(chat_id, None)
+        save_json(self.filename, self.enabled)
+
+    # 关闭时同时丢弃已记录的消息
+    def disable(self, chat_id: int) -> None:
+        self.enabled.pop(str(chat_id), None)
+        self.histories.pop(chat_id, None)
+        save_json(self.filename, self.enabled)
+
+    def record(self, chat_id: int, message_id: int, name: str, text: str) -> None:
+        capacity = self.capacity(chat_id)
+        if not capacity or not text:
+            return
+        history = self.histories.get(chat_id)
+        if history is None:
+            history = self.histories[chat_id] = GroupHistory(capacity)
+        line = f'{name}: {text[:Config.GROUP_CONTEXT_MAX_CHARS]}'
+        history.add(message_id, time.time(), line.encode())
+
+    # 从最新的消息往前取，直到达到token预算，按时间顺序返回
+    def build_context(self, chat_id: int, model: str, exclude_message_id: Optional[int] = None) -> Optional[str]:
+        history = self.histories.get(chat_id)
+        if history is None:
+            return None
+        lines = []
+        tokens = 0
+        for message_id, line in history.recent(time.time() - Config.GROUP_CONTEXT_RETENTION):
+            if message_id == exclude_message_id:
+                continue
+            text = line.decode()
+            cost = count_tokens(text, model) + 1
+            if tokens + cost > Config.GROUP_CONTEXT_MAX_TOKENS:
+                break
+            lines.append(text)
+            tokens += cost
+        if not lines:
+            return None
+        lines.reverse()
+        return '\n'.join(lines)
+
+    def memory_size(self) -> int:
+        return sum(history.memory_size() for history in self.histories.values())
+
+group_contexts = GroupContextStore(GROUP_CONTEXT_FILE)
+metrics.gauge('group_context_chats', '开启群聊上下文并已有记录的群数', lambda: len(group_contexts.histories))
+metrics.gauge('group_context_bytes', '群聊上下文占用的估算内存（字节）', group_contexts.memory_size)
+
+# 某个用户在某个聊天中生效的设置（聊天设置覆盖全局设置），创建后不可修改
+class EffectiveSettings:
+    __slots__ = ('model', 'voice', 'stream_output')
+
+    def __init__(self, settings: dict):
+        object.__setattr__(self, 'model', settings.get('model', MODELS[0]))
+        object.__setattr__(self, 'voice', settings.get('voice', DEFAULT_VOICE))
+        object.__setattr__(self, 'stream_output', settings.get('stream_output', False))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('EffectiveSettings is immutable')
+
+# 用户设置快照中每个用户占一行：`"用户ID": {...},`（按换行匹配比 re.M 的 ^ 快）
+SETTINGS_LINE_PATTERN = re.compile(rb'\n"(-?\d+)": ')
+
+# 用户设置存储：内存中缓存每个(用户, 聊天)生效的设置，修改追加写入日志文件，
+# 在事件循环之外批量延迟落盘；日志过长时原子地重写快照（仍是合法的JSON，每个用户占一行）。
+# 启动时不读取快照，第一次查找时用mmap为快照建立 用户ID -> 行偏移 的索引，只解析用到的用户；
+# 旧版的单行快照在第一次查找时整体加载，下次重写快照时转换为新格式。
+# 配置了共享存储时不使用文件：每个用户的设置是共享存储中的一个哈希（字段为 global 或聊天ID），
+# 处理更新前通过 prefetch 加载，修改后写入共享存储并通知其他进程
+class SettingsStore:
+    def __init__(self, filename: str, shared: Any = None):
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.shared = shared
+        # 已解析或修改过的用户设置（共享模式下为None表示该用户没有设置）；其余用户只在 _offsets 中记录设置在快照中的位置
+        self.data: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._offsets: Optional[Dict[int, int]] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._replayed = False
+        # user_id -> chat_id -> 生效的设置，只在设置被修改时失效
+        self._effective: Dict[int, Dict[int, EffectiveSettings]] = {}
+        self._default: Optional[EffectiveSettings] = None
+        self._pending: list = []
+        self._journal_entries = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def _ensure_loaded(self) -> None:
+        if self._offsets is not None:
+            return
+        if self.shared is not None:
+            self._offsets = {}
+            return
+        self._index_snapshot()
+        if not self._replayed:
+            self._replayed = True
+            # 日志中的条目计入下一次压缩，不在启动时重写快照
+            self._journal_entries += self._replay_journal()
+
+    def _index_snapshot(self) -> None:
+        self._close_snapshot()
+        self._offsets = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        if self._mmap[:3] not in (b'{\n"', b'{\n}'):
+            # 旧版格式：整体加载，并让下一次落盘时重写快照
+            for user_id_str, user in json.loads(self._mmap[:]).items():
+                self.data.setdefault(user_id_str, user)
+            self._mmap.close()
+            self._mmap = None
+            self._journal_entries = Config.SETTINGS_COMPACT_THRESHOLD
+            return
+        for match in SETTINGS_LINE_PATTERN.finditer(self._mmap):
+            self._offsets[int(match.group(1))] = match.end()
+        # 内存中已有的用户以内存为准
+        for user_id_str in self.data:
+            self._offsets.pop(int(user_id_str), None)
+
+    def _close_snapshot(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._offsets = None
+
+    def _read_line(self, offset: int) -> bytes:
+        end = self._mmap.find(b'\n', offset)
+        return self._mmap[offset:end].rstrip(b',')
+
+    # 返回用户的设置（没有设置时返回None），第一次访问时从快照中解析
+    def _user(self, user_id_str: str) -> Optional[Dict[str, Any]]:
+        if user_id_str not in self.data:
+            self._ensure_loaded()
+            offset = self._offsets.pop(int(user_id_str), None)
+            if offset is not None:
+                self.data[user_id_str] = json.loads(self._read_line(offset))
+        return self.data.get(user_id_str)
+
+    def _replay_journal(self) -> int:
+        try:
+            with open(self.journal_filename, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # 崩溃时写了一半的最后一行
+            self._apply(entry['u'], entry['c'], entry['k'], entry['v'])
+        return len(lines)
+
+    async def prefetch(self, user_id: int) -> None:
+        user_id_str = str(user_id)
+        if self.shared is None or user_id_str in self.data:
+            return
+        fields = await asyncio.to_thread(self.shared.get_hash, f'settings:{user_id_str}')
+        # 等待期间本进程可能已经修改了该用户的设置，以内存为准
+        self.data.setdefault(user_id_str, self._from_fields(fields) if fields else None)
+
+    @staticmethod
+    def _from_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+        fields = dict(fields)
+        return {"global": fields.pop('global', {}), "chats": fields}
+
+    # 其他进程修改了设置：只更新已经加载的用户，未加载的用户下次访问时从共享存储读取
+    def apply_remote(self, changes: list) -> None:
+        for user_id_str, field, value in changes:
+            if user_id_str not in self.data:
+                continue
+            user = self.data[user_id_str] or {"global": {}, "chats": {}}
+            if field == 'global':
+                user["global"] = value
+            else:
+                user.setdefault("chats", {})[field] = value
+            self.data[user_id_str] = user
+            self._effective.pop(int(user_id_str), None)
+
+    def _apply(self, user_id_str: str, chat_id_str: Optional[str], key: str, value: Any) -> None:
+        user = self._user(user_id_str)
+        if user is None:
+            user = self.data[user_id_str] = {"global": {}, "chats": {}}
+        user_id = int(user_id_str)
+        if chat_id_str is None:
+            user.setdefault("global", {})[key] = value
+            self._effective.pop(user_id, None)
         else:
-            return user_settings[user_id_str]["global"].get(key, default)
-    return default
+            user.setdefault("chats", {}).setdefault(chat_id_str, {})[key] = value
+            self._effective.get(user_id, {}).pop(int(chat_id_str), None)
+
+    def effective(self, user_id: int, chat_id: int) -> EffectiveSettings:
+        chats = self._effective.get(user_id)
+        if chats is not None:
+            settings = chats.get(chat_id)
+            if settings is not None:
+                return settings
+        user = self._user(str(user_id))
+        if user is None:
+            if self._default is None:
+                self._default = EffectiveSettings({})
+            return self._default
+        settings = EffectiveSettings({**user.get("global", {}), **user.get("chats", {}).get(str(chat_id), {})})
+        self._effective.setdefault(user_id, {})[chat_id] = settings
+        return settings
+
+    # 默认值（如 MODELS[0]）变化时清空缓存
+    def invalidate(self) -> None:
+        self._effective.clear()
+        self._default = None
+
+    def set(self, user_id: int, chat_id: int, key: str, value: Any) -> None:
+        user_id_str = str(user_id)
+        chat_id_str = str(chat_id)
+        # 如果是私聊，设置全局设置
+        self._record(user_id_str, None if chat_id_str == user_id_str else chat_id_str, key, value)
+        self._schedule_flush()
+
+    # 把所有等于old的设置改为new（例如删除模型时），需要解析快照中（或共享存储中）的所有用户
+    # 共享存储的扫描在线程中进行，修改和其他设置一样由 flush 在线程中写入
+    async def replace_value(self, key: str, old: Any, new: Any) -> None:
+        self._ensure_loaded()
+        for user_id in list(self._offsets):
+            self._user(str(user_id))
+        if self.shared is not None:
+            for hash_key, fields in (await asyncio.to_thread(self.shared.scan_hashes, 'settings:')).items():
+                user_id_str = hash_key[len('settings:'):]
+                if self.data.get(user_id_str) is None:
+                    self.data[user_id_str] = self._from_fields(fields)
+        for user_id_str, user in list(self.data.items()):
+            if user is None:
+                continue
+            if user.get("global", {}).get(key) == old:
+                self._record(user_id_str, None, key, new)
+            for chat_id_str, chat in list(user.get("chats", {}).items()):
+                if chat.get(key) == old:
+                    self._record(user_id_str, chat_id_str, key, new)
+        self._schedule_flush()
+
+    def _record(self, user_id_str: str, chat_id_str: Optional[str], key: str, value: Any) -> None:
+        self._apply(user_id_str, chat_id_str, key, value)
+        self._pending.append({'u': user_id_str, 'c': chat_id_str, 'k': key, 'v': value})
+
+    def _schedule_flush(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_sync()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(Config.SETTINGS_FLUSH_DELAY, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            entries, self._pending = self._pending, []
+            if self.shared is not None:
+                await asyncio.to_thread(self._write_shared, self._shared_changes(entries))
+            elif self._journal_entries + len(entries) >= Config.SETTINGS_COMPACT_THRESHOLD:
+                await asyncio.to_thread(self._write_snapshot, self._snapshot_payload())
+                self._journal_entries = 0
+                # 旧快照的偏移已失效，下次查找未解析的用户时重新建立索引
+                self._close_snapshot()
+            else:
+                await asyncio.to_thread(self._append_journal, entries)
+                self._journal_entries += len(entries)
+
+    def _flush_sync(self) -> None:
+        entries, self._pending = self._pending, []
+        if self.shared is not None:
+            self._write_shared(self._shared_changes(entries))
+            return
+        self._append_journal(entries)
+        self._journal_entries += len(entries)
+
+    # 每个被修改的 (用户, global或聊天ID) 取当前的完整设置，同一进程内的多次修改只写一次
+    def _shared_changes(self, entries: list) -> list:
+        fields = {(entry['u'], entry['c'] or 'global') for entry in entries}
+        changes = []
+        for user_id_str, field in fields:
+            user = self.data[user_id_str]
+            value = user["global"] if field == 'global' else user["chats"][field]
+            changes.append([user_id_str, field, dict(value)])
+        return changes
+
+    # 按聊天归属，同一个字段只会由一个进程修改，所以按字段写入不会覆盖其他进程的修改
+    def _write_shared(self, changes: list) -> None:
+        hashes: Dict[str, Dict[str, Any]] = {}
+        for user_id_str, field, value in changes:
+            hashes.setdefault(f'settings:{user_id_str}', {})[field] = value
+        self.shared.set_hashes(hashes)
+        self.shared.publish('settings', {'changes': changes, 'origin': WORKER_TOKEN})
+
+    # 第一次使用共享存储时，把本地文件中的设置导入共享存储（只执行一次）
+    def import_to_shared(self) -> int:
+        if self.shared.get('settings_imported'):
+            return 0
+        local = SettingsStore(self.filename)
+        local._ensure_loaded()
+        for user_id in list(local._offsets):
+            local._user(str(user_id))
+        hashes = {
+            f'settings:{user_id_str}': {'global': user.get("global", {}), **user.get("chats", {})}
+            for user_id_str, user in local.data.items()
+        }
+        self.shared.set_hashes(hashes)
+        self.shared.set('settings_imported', True)
+        return len(hashes)
+
+    def _append_journal(self, entries: list) -> None:
+        with open(self.journal_filename, 'a') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    # 未解析的用户直接复制快照中的原始行，不需要解析整个文件
+    def _snapshot_payload(self) -> bytes:
+        self._ensure_loaded()
+        lines = [b'"%d": %s' % (user_id, self._read_line(offset)) for user_id, offset in self._offsets.items()]
+        lines.extend(f'{json.dumps(user_id_str)}: {json.dumps(user)}'.encode() for user_id_str, user in self.data.items())
+        if not lines:
+            return b'{\n}\n'
+        return b'{\n' + b',\n'.join(lines) + b'\n}\n'
+
+    # 先写临时文件再原子替换，避免写到一半崩溃导致设置文件损坏
+    def _write_snapshot(self, payload: bytes) -> None:
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        try:
+            os.remove(self.journal_filename)
+        except FileNotFoundError:
+            pass
+
+settings_store = SettingsStore(USER_SETTINGS_FILE, shared_state)
+
+# 用户设置处理
+def get_effective_settings(user_id: int, chat_id: int) -> EffectiveSettings:
+    return settings_store.effective(user_id, chat_id)
 
 def set_user_setting(user_id: int, chat_id: int, key: str, value: Any) -> None:
-    user_id_str = str(user_id)
-    chat_id_str = str(chat_id)
-    if user_id_str not in user_settings:
-        user_settings[user_id_str] = {"global": {}, "chats": {}}
-    if chat_id_str == user_id_str:  # 如果是私聊，设置全局设置
-        user_settings[user_id_str]["global"][key] = value
-    else:
-        if chat_id_str not in user_settings[user_id_str]["chats"]:
-            user_settings[user_id_str]["chats"][chat_id_str] = {}
-        user_settings[user_id_str]["chats"][chat_id_str][key] = value
-    save_json(USER_SETTINGS_FILE, user_settings)
+    settings_store.set(user_id, chat_id, key, value)
+
+# 多进程共享状态：管理员修改的值写入共享存储并通知其他进程；每个进程在后台读取通知并更新自己的副本
+shared_notifications = metrics.counter('shared_state_notifications_total', '收到的其他进程的变更通知数')
+forwarded_updates = metrics.counter('forwarded_updates_total', '按聊天归属转发给其他进程的更新数')
+
+def apply_allowed_users(value: list) -> None:
+    allowed_users.clear()
+    allowed_users.update(value)
+
+def apply_models(value: list) -> None:
+    MODELS[:] = value
+    settings_store.invalidate()
+
+def apply_api_keys(value: Dict[str, str]) -> None:
+    api_key_overrides.clear()
+    api_key_overrides.update(value)
+    if '' in value:
+        Config.OPENAI_API_KEY = value['']
+    if _openai_clients is not None:
+        for name, api_key in value.items():
+            _openai_clients.set_api_key(api_key, name or None)
+
+# 名称 -> (本进程的当前值, 应用其他进程的修改)
+SHARED_VALUES: Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]] = {
+    'allowed_users': (lambda: sorted(allowed_users), apply_allowed_users),
+    'models': (lambda: list(MODELS), apply_models),
+    'api_keys': (lambda: dict(api_key_overrides), apply_api_keys),
+}
+
+async def share_value(name: str) -> None:
+    if shared_state is None:
+        return
+    value = SHARED_VALUES[name][0]()
+    await asyncio.to_thread(shared_state.set, name, value)
+    await asyncio.to_thread(shared_state.publish, 'value', {'name': name, 'value': value, 'origin': WORKER_TOKEN})
+
+def apply_change(channel: str, message: dict) -> None:
+    if channel == 'value':
+        SHARED_VALUES[message['name']][1](message['value'])
+    elif channel == 'settings':
+        settings_store.apply_remote(message['changes'])
+
+# 后台任务：读取其他进程的通知；把不属于本进程的更新按到达顺序批量写入共享存储（保证同一聊天的更新不乱序）；
+# 取出转发给本进程的更新放入 Application 的更新队列
+class SharedStateSync:
+    def __init__(self):
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+        self.tasks: list = []
+        self.stopping = False
+        # 阻塞等待通知和转发的更新使用单独的线程，不占用 asyncio.to_thread 的默认线程池
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def forward(self, worker_id: int, update: Update) -> None:
+        self.outgoing.put_nowait((f'updates:{worker_id}', update.to_dict()))
+        forwarded_updates.inc(worker=str(worker_id))
+
+    def start(self, application: Application, cursor: Any) -> None:
+        self.stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='shared-state')
+        self.tasks = [asyncio.create_task(self._listen(cursor))]
+        if Config.WORKER_COUNT > 1:
+            self.tasks.append(asyncio.create_task(self._push()))
+            self.tasks.append(asyncio.create_task(self._consume(application)))
+
+    # 后台线程中的阻塞调用无法取消，等它们在 SHARED_STATE_BLOCK_TIMEOUT 内自行结束
+    async def stop(self) -> None:
+        self.stopping = True
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def _blocking(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _listen(self, cursor: Any) -> None:
+        while not self.stopping:
+            try:
+                cursor, changes = await self._blocking(shared_state.poll, cursor, SHARED_STATE_BLOCK_TIMEOUT)
+            except Exception as e:
+                record_error('shared_state', e)
+                await asyncio.sleep(SHARED_STATE_BLOCK_TIMEOUT)
+                continue
+            for channel, message in changes:
+                if message.get('origin') != WORKER_TOKEN:
+                    shared_notifications.inc(channel=channel)
+                    apply_change(channel, message)
+
+    async def _push(self) -> None:
+        while not (self.stopping and self.outgoing.empty()):
+            try:
+                items = [await asyncio.wait_for(self.outgoing.get(), SHARED_STATE_BLOCK_TIMEOUT)]
+            except asyncio.TimeoutError:
+                continue
+            while not self.outgoing.empty():
+                items.append(self.outgoing.get_nowait())
+            try:
+                await asyncio.to_thread(shared_state.push, items)
+            except Exception as e:
+                record_error('forward_update', e)
+                logger.error('转发 %d 个更新失败: %r', len(items), e)
+
+    async def _consume(self, application: Application) -> None:
+        name = f'updates:{Config.WORKER_ID}'
+        while not self.stopping:
+            if not application.running:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                items = await self._blocking(shared_state.pop, name, SHARED_STATE_BLOCK_TIMEOUT)
+            except Exception as e:
+                record_error('consume_updates', e)
+                await asyncio.sleep(SHARED_STATE_BLOCK_TIMEOUT)
+                continue
+            if items and not application.running:
+                # 等待期间开始停止了，放回队列由下次启动处理
+                await asyncio.to_thread(shared_state.push, [(name, data) for data in items])
+                continue
+            for data in items:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+
+shared_sync = SharedStateSync()
+
+# 聊天归属：同一聊天的所有更新都由同一个进程处理，会话、群聊上下文和按聊天排队都只在这个进程中
+def chat_owner(chat_id: int) -> int:
+    return chat_id % Config.WORKER_COUNT
+
+# 启动时先记下通知的位置再读取共享的值，避免漏掉中间的修改；共享存储中还没有的值用本进程的文件初始化
+async def start_shared_state(application: Application) -> None:
+    cursor = await asyncio.to_thread(shared_state.latest_cursor)
+    for name, (current, apply) in SHARED_VALUES.items():
+        value = await asyncio.to_thread(shared_state.get, name)
+        if value is None:
+            await asyncio.to_thread(shared_state.set, name, current())
+        else:
+            apply(value)
+    if Config.WORKER_ID == 0:
+        imported = await asyncio.to_thread(settings_store.import_to_shared)
+        if imported:
+            logger.info('已把 %d 个用户的设置导入共享存储', imported)
+    shared_sync.start(application, cursor)
 
 # 帮助信息生成
 def get_help_message(is_admin: bool = False) -> str:
@@ -99,19 +1902,22 @@ def get_help_message(is_admin: bool = False) -> str:
         "/current_settings - 显示当前使用的设置\n"
         "/set_voice <voice> - 设置TTS声音\n"
         "/toggle_stream - 切换流式输出模式\n"
-        "/draw <prompt> - 使用DALL-E 3生成图像\n"
+        "/draw [n=1] [size=1024x1024] <prompt> - 使用DALL-E 3生成图像\n"
+        "/cancel_draw - 取消您在当前聊天中的绘画任务\n"
         "/chat <message> - 在群组中开始新的对话\n"
+        "/group_context [on [条数]|off] - 在群组中开启或关闭群聊上下文（群管理员）\n"
         "\n直接发送消息开始新对话，回复机器人消息继续上下文对话。"
     )
     if is_admin:
         help_message += (
             "\n管理员命令：\n"
-            "/set_api_key <key> - 设置新的API密钥\n"
+            "/set_api_key <key> [upstream] - 设置新的API密钥（可指定上游）\n"
             "/add_user <user_id> - 添加新的允许用户\n"
             "/remove_user <user_id> - 删除允许的用户\n"
             "/add_model <model> - 添加新的模型\n"
             "/remove_model <model> - 删除模型\n"
             "/list_users - 列出所有允许的用户\n"
+            "/stats - 查看运行统计\n"
         )
     return help_message
 
@@ -136,30 +1942,64 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         await update.message.reply_text('抱歉，您没有使用权限。')
 
+# /redo 的新回答：优先使用预取的回答，预取失败时（例如上游出错）改为直接生成
+async def regenerate_answer(prefetched: Optional[asyncio.Task], user_id: int, model: str, session: ChatSession, priority: int) -> str:
+    if prefetched is not None:
+        try:
+            return await prefetched
+        except Exception:
+            # 错误已由 RedoPrefetcher._on_done 记录
+            pass
+    return await get_gpt_response(user_id, model, session, use_cache=False, priority=priority)
+
 async def redo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     session_key = get_session_key(user_id, chat_id)
-    if session_key in user_sessions and len(user_sessions[session_key]) >= 2:
-        user_sessions[session_key].pop()
-        processing_message = await update.message.reply_text("正在重新生成回答，请稍候...")
+    async with session_locks.lock(session_key):
+        session = await user_sessions.get(session_key)
+        if session is None or len(session) < 2:
+            await update.message.reply_text('没有可以重做的消息。')
+            return
+        if not await admit_request(update, 'chat'):
+            return
+        redo_prefetcher.record_redo(user_id)
+        requested_model = get_effective_settings(user_id, chat_id).model
+        model = await model_fallback.choose(requested_model)
+        prefetched = redo_prefetcher.take(session_key, session, model)
+        previous = session.pop()
+        answered = False
+        # 预取已经完成时直接发送回答
+        processing_message = None
         try:
-            response = get_gpt_response(user_id, chat_id, user_sessions[session_key])
-            user_sessions[session_key].append({'role': 'assistant', 'content': response})
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=processing_message.message_id,
-                text=response,
-                parse_mode=ParseMode.MARKDOWN
+            if prefetched is None or not prefetched.done():
+                processing_message = await update.message.reply_text("正在重新生成回答，请稍候...")
+            response = await session_locks.run_generation(
+                session_key,
+                regenerate_answer(prefetched, user_id, model, session, request_priority(user_id, chat_id))
             )
+            session.append('assistant', response)
+            answered = True
+            await user_sessions.save(session_key)
+            await send_formatted_reply(context.bot, chat_id, processing_message and processing_message.message_id, response)
+            redo_prefetcher.schedule(session_key, user_id, model, session)
         except Exception as e:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=processing_message.message_id,
-                text="抱歉，重新生成回答时发生了错误。请稍后再试。"
-            )
-    else:
-        await update.message.reply_text('没有可以重做的消息。')
+            if isinstance(e, GenerationCancelled):
+                error_text = "已取消：收到了新的消息。"
+            else:
+                record_error('redo', e)
+                error_text = "抱歉，重新生成回答时发生了错误。请稍后再试。"
+            if processing_message is None:
+                await update.message.reply_text(error_text)
+            else:
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
+            return
+        finally:
+            # 没有得到新回答时放回原来的回答，否则下次 /redo 会删掉用户的问题
+            if not answered:
+                session.append(previous['role'], previous['content'])
+
+    await notify_fallback(update, requested_model, model)
 
 async def set_api_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -167,13 +2007,21 @@ async def set_api_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text('只有管理员可以设置API密钥。')
         return
 
-    if len(context.args) != 1:
-        await update.message.reply_text('请提供新的API密钥。')
+    if len(context.args) not in (1, 2):
+        await update.message.reply_text('请提供新的API密钥（可选：上游名称）。')
         return
 
-    Config.OPENAI_API_KEY = context.args[0]
-    global client
-    client = OpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL)
+    name = context.args[1] if len(context.args) == 2 else None
+    clients = await get_openai_clients_async()
+    if not clients.set_api_key(context.args[0], name):
+        await update.message.reply_text(f'没有名为 {name} 的上游。')
+        return
+    if name is None:
+        Config.OPENAI_API_KEY = context.args[0]
+    # 先删除再写入，让这次设置排在最后，重放时不会被更早的设置覆盖
+    api_key_overrides.pop(name or '', None)
+    api_key_overrides[name or ''] = context.args[0]
+    await share_value('api_keys')
     await update.message.reply_text('API密钥已更新。')
 
 async def set_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -211,8 +2059,7 @@ async def toggle_stream_output(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text('抱歉，您没有使用权限。')
         return
 
-    current_setting = get_user_setting(user_id, chat_id, 'stream_output', False)
-    new_setting = not current_setting
+    new_setting = not get_effective_settings(user_id, chat_id).stream_output
     set_user_setting(user_id, chat_id, 'stream_output', new_setting)
     await update.message.reply_text(f'流式输出已{"开启" if new_setting else "关闭"}。')
 
@@ -229,6 +2076,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     new_user_id = int(context.args[0])
     allowed_users.add(new_user_id)
     save_json(USERS_FILE, list(allowed_users))
+    await share_value('allowed_users')
     await update.message.reply_text(f'用户 {new_user_id} 已被添加到允许列表。')
 
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -245,6 +2093,7 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if remove_user_id in allowed_users:
         allowed_users.remove(remove_user_id)
         save_json(USERS_FILE, list(allowed_users))
+        await share_value('allowed_users')
         await update.message.reply_text(f'用户 {remove_user_id} 已从允许列表中删除。')
     else:
         await update.message.reply_text(f'用户 {remove_user_id} 不在允许列表中。')
@@ -265,6 +2114,7 @@ async def add_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     else:
         MODELS.append(new_model)
         save_json(MODELS_FILE, MODELS)
+        await share_value('models')
         await update.message.reply_text(f'模型 {new_model} 已被添加到可用模型列表。')
 
 async def remove_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -281,10 +2131,9 @@ async def remove_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if remove_model_name in MODELS:
         MODELS.remove(remove_model_name)
         save_json(MODELS_FILE, MODELS)
-        for settings_key, settings in user_settings.items():
-            if settings.get('model') == remove_model_name:
-                settings['model'] = MODELS[0]
-        save_json(USER_SETTINGS_FILE, user_settings)
+        await share_value('models')
+        await settings_store.replace_value('model', remove_model_name, MODELS[0])
+        settings_store.invalidate()
         await update.message.reply_text(f'模型 {remove_model_name} 已从可用模型列表中删除。使用此模型的用户已被更新为默认模型。')
     else:
         await update.message.reply_text(f'模型 {remove_model_name} 不在可用模型列表中。')
@@ -306,36 +2155,32 @@ async def current_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     chat_id = update.effective_chat.id
     if is_user_allowed(user_id, chat_id):
         try:
-            global_model = get_user_setting(user_id, user_id, 'model', MODELS[0])
-            global_voice = get_user_setting(user_id, user_id, 'voice', DEFAULT_VOICE)
-            global_stream_output = get_user_setting(user_id, user_id, 'stream_output', False)
-            
-            chat_model = get_user_setting(user_id, chat_id, 'model', global_model)
-            chat_voice = get_user_setting(user_id, chat_id, 'voice', global_voice)
-            chat_stream_output = get_user_setting(user_id, chat_id, 'stream_output', global_stream_output)
-            
+            global_settings = get_effective_settings(user_id, user_id)
             settings_message = (
                 f'您的全局设置：\n'
-                f'模型: {global_model}\n'
-                f'TTS声音: {global_voice}\n'
-                f'流式输出: {"开启" if global_stream_output else "关闭"}\n\n'
+                f'模型: {global_settings.model}\n'
+                f'TTS声音: {global_settings.voice}\n'
+                f'流式输出: {"开启" if global_settings.stream_output else "关闭"}\n\n'
             )
             
             if chat_id != user_id:
+                chat_settings = get_effective_settings(user_id, chat_id)
                 settings_message += (
                     f'当前聊天的设置：\n'
-                    f'模型: {chat_model}\n'
-                    f'TTS声音: {chat_voice}\n'
-                    f'流式输出: {"开启" if chat_stream_output else "关闭"}'
+                    f'模型: {chat_settings.model}\n'
+                    f'TTS声音: {chat_settings.voice}\n'
+                    f'流式输出: {"开启" if chat_settings.stream_output else "关闭"}'
                 )
             
             await update.message.reply_text(settings_message)
         except Exception as e:
+            record_error('current_settings', e)
             await update.message.reply_text('获取当前设置时发生错误。请稍后再试。')
     else:
         await update.message.reply_text('抱歉，您没有使用权限。')
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    started = time.monotonic()
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     if not is_user_allowed(user_id, chat_id):
@@ -343,113 +2188,947 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     is_voice = update.message.voice is not None
-    
+    is_reply = update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id
+    if not is_reply and chat_id < 0:  # 群组的 chat_id 是负数
+        return
+
+    if not await admit_request(update, *(('audio', 'chat') if is_voice else ('chat',))):
+        return
+
     if is_voice:
         message = await process_voice_message(update, context)
     else:
         message = update.message.text
-    
-    is_reply = update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id
 
     session_key = get_session_key(user_id, chat_id)
-    if not is_reply:
-        if chat_id < 0:  # 群组的 chat_id 是负数
-            return
-        user_sessions[session_key] = []
+    async with session_locks.lock(session_key):
+        if not is_reply:
+            session = user_sessions.new(session_key)
+        else:
+            session = await user_sessions.get(session_key) or user_sessions.new(session_key)
 
-    if session_key not in user_sessions:
-        user_sessions[session_key] = []
+        session.append('user', message)
 
-    user_sessions[session_key].append({'role': 'user', 'content': message})
-    
-    processing_message = await update.message.reply_text("正在处理您的请求，请稍候...")
+        processing_message = await update.message.reply_text("正在处理您的请求，请稍候...")
 
-    try:
-        response = get_gpt_response(user_id, chat_id, user_sessions[session_key])
-        user_sessions[session_key].append({'role': 'assistant', 'content': response})
-        
-        voice = get_user_setting(user_id, chat_id, 'voice', DEFAULT_VOICE)
-        stream_output = get_user_setting(user_id, chat_id, 'stream_output', False)
-        
-        if is_voice:
-            await send_voice_response(update, context, response, voice)
-            await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-            
-            if stream_output:
-                await stream_response(update, context, response)
-            else:
-                await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
-        else:
-            if stream_output:
-                await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-                await stream_response(update, context, response)
+        settings = get_effective_settings(user_id, chat_id)
+        if chat_id < 0:
+            session.group_context = group_contexts.build_context(chat_id, settings.model, update.message.message_id)
+            # 文字消息已由 record_group_message 记录，语音消息记录转写的文字
+            if is_voice:
+                group_contexts.record(chat_id, update.message.message_id, update.effective_user.full_name, message)
+        # 语音消息：文字回复和语音合成同时进行
+        voice_responder = VoiceResponder(update, context, settings.voice) if is_voice else None
+        model = await model_fallback.choose(settings.model)
+
+        try:
+            if settings.stream_output:
+                # 流式输出：回答在"正在处理"消息上边生成边显示，完整的句子立即开始合成语音
+                response = await session_locks.run_generation(
+                    session_key,
+                    stream_response(update, context, processing_message, model, session, started, voice_responder)
+                )
             else:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=processing_message.message_id,
-                    text=response,
-                    parse_mode=ParseMode.MARKDOWN
+                response = await session_locks.run_generation(
+                    session_key,
+                    get_gpt_response(user_id, model, session, priority=request_priority(user_id, chat_id))
                 )
-    except Exception as e:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=processing_message.message_id,
-            text="抱歉，处理您的请求时发生了错误。请稍后再试。"
-        )
+                if voice_responder is not None:
+                    voice_responder.feed(response)
+                await send_formatted_reply(context.bot, chat_id, processing_message.message_id, response)
+            session.append('assistant', response)
+            await user_sessions.save(session_key)
+            redo_prefetcher.schedule(session_key, user_id, model, session)
+            if chat_id < 0:
+                group_contexts.record(chat_id, processing_message.message_id, '机器人', response)
+        except GenerationCancelled:
+            if voice_responder is not None:
+                voice_responder.cancel()
+            session.pop()
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=processing_message.message_id,
+                text="已取消：收到了新的消息。"
+            )
+            return
+        except Exception as e:
+            record_error('handle_message', e)
+            if voice_responder is not None:
+                voice_responder.cancel()
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=processing_message.message_id,
+                text="抱歉，处理您的请求时发生了错误。请稍后再试。"
+            )
+            return
+
+    await notify_fallback(update, settings.model, model)
+    if voice_responder is not None:
+        await voice_responder.finish()
+
+# 音频处理统计：下载/合成的字节数，以及因超过内存上限而转存到磁盘的次数
+class AudioMetrics:
+    def __init__(self):
+        self.bytes_downloaded = 0
+        self.bytes_synthesized = 0
+        self.buffers = 0
+        self.spooled_to_disk = 0
+
+    def record_buffer(self, size: int) -> None:
+        self.buffers += 1
+        if size > Config.AUDIO_MEMORY_LIMIT:
+            self.spooled_to_disk += 1
+
+    @staticmethod
+    def open_fds() -> int:
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return -1
+
+audio_metrics = AudioMetrics()
+metrics.counter('audio_bytes_downloaded_total', '下载的语音字节数', lambda: audio_metrics.bytes_downloaded)
+metrics.counter('audio_bytes_synthesized_total', '合成的语音字节数', lambda: audio_metrics.bytes_synthesized)
+metrics.counter('audio_buffers_spooled_to_disk_total', '超过内存上限而转存到磁盘的音频缓冲区数', lambda: audio_metrics.spooled_to_disk)
+metrics.gauge('process_open_fds', '进程打开的文件描述符数', AudioMetrics.open_fds)
+
+# 音频缓冲区：不超过 AUDIO_MEMORY_LIMIT 时完全在内存中，超过后自动转存到临时文件
+def new_audio_buffer() -> tempfile.SpooledTemporaryFile:
+    return tempfile.SpooledTemporaryFile(max_size=Config.AUDIO_MEMORY_LIMIT)
 
 async def process_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-    voice_file = await context.bot.get_file(update.message.voice.file_id)
-    with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as voice_ogg:
-        await voice_file.download_to_drive(voice_ogg.name)
-        
-        with open(voice_ogg.name, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file
+    with new_audio_buffer() as voice_ogg:
+        with stage_latency.time(stage='telegram_download'):
+            voice_file = await context.bot.get_file(update.message.voice.file_id)
+            await voice_file.download_to_memory(voice_ogg)
+        size = voice_ogg.tell()
+        audio_metrics.bytes_downloaded += size
+        audio_metrics.record_buffer(size)
+
+        # httpx 上传文件对象时会调用 fileno() 获取长度，这会让还在内存中的缓冲区转存到磁盘，所以内存中的缓冲区直接传入内容
+        if size > Config.AUDIO_MEMORY_LIMIT:
+            upload = voice_ogg
+        else:
+            voice_ogg.seek(0)
+            upload = voice_ogg.read()
+
+        # 每次重试都从头上传同一份内容，因此不发对冲请求
+        async def transcribe(client: 'AsyncOpenAI'):
+            voice_ogg.seek(0)
+            return await client.audio.transcriptions.create(
+                model="whisper-1",
+                file=("voice.ogg", upload)
             )
-        
-        os.unlink(voice_ogg.name)  # 删除临时文件
+
+        async with openai_limiter.slot(update.effective_user.id, request_priority(update.effective_user.id, update.effective_chat.id)):
+            with stage_latency.time(stage='whisper'):
+                transcript = await openai_request('audio', 'whisper-1', transcribe, hedge=False)
         return transcript.text
 
-async def send_voice_response(update: Update, context: ContextTypes.DEFAULT_TYPE, response: str, voice: str) -> None:
-    speech_file_path = tempfile.mktemp(suffix=".mp3")
-    with client.audio.speech.with_streaming_response.create(
-        model="tts-1",
-        voice=voice,
-        input=response
-    ) as response_audio:
-        with open(speech_file_path, 'wb') as f:
-            for chunk in response_audio.iter_bytes():
-                f.write(chunk)
-    
-    await context.bot.send_voice(
-        chat_id=update.effective_chat.id,
-        voice=open(speech_file_path, 'rb')
-    )
-    os.remove(speech_file_path)
-
-async def stream_response(update: Update, context: ContextTypes.DEFAULT_TYPE, response: str):
-    message = await update.message.reply_text("...")
-    for i in range(0, len(response), 100):  # 每次发送100个字符
-        chunk = response[i:i+100]
-        await asyncio.sleep(0.5)  # 模拟打字效果
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=message.message_id,
-            text=response[:i+100],
-            parse_mode=ParseMode.MARKDOWN
-        )
+# 合成语音，返回定位到开头的缓冲区，由调用方负责关闭
+async def synthesize_speech(user_id: int, text: str, voice: str, priority: int = PRIORITY_GROUP) -> tempfile.SpooledTemporaryFile:
+    speech = new_audio_buffer()
+
+    # 重试时丢弃已写入的部分，重新下载
+    async def download(client: 'AsyncOpenAI') -> None:
+        speech.seek(0)
+        speech.truncate()
+        async with client.audio.speech.with_streaming_response.create(
+            model="tts-1",
+            voice=voice,
+            input=text
+        ) as response_audio:
+            async for chunk in response_audio.iter_bytes():
+                speech.write(chunk)
 
-def get_gpt_response(user_id: int, chat_id: int, messages: list) -> str:
     try:
-        model = get_user_setting(user_id, chat_id, 'model', MODELS[0])
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
-        return response.choices[0].message.content
-    except Exception as e:
+        async with openai_limiter.slot(user_id, priority):
+            with stage_latency.time(stage='tts'):
+                await openai_request('audio', 'tts-1', download, hedge=False)
+    except BaseException:
+        speech.close()
         raise
+    size = speech.tell()
+    audio_metrics.bytes_synthesized += size
+    audio_metrics.record_buffer(size)
+    speech.seek(0)
+    return speech
+
+# 从文本开头切出一段可以合成语音的内容：至少min_chars个字符并在句末结束，最长不超过TTS输入上限
+def split_speech_chunk(text: str, min_chars: int, final: bool = False) -> Tuple[str, str]:
+    if final and len(text) <= TTS_INPUT_LIMIT:
+        return text, ''
+    match = SENTENCE_END_PATTERN.search(text, max(min_chars - 1, 0), TTS_INPUT_LIMIT)
+    if match is not None:
+        return text[:match.end()], text[match.end():]
+    if len(text) >= TTS_INPUT_LIMIT:
+        return text[:TTS_INPUT_LIMIT], text[TTS_INPUT_LIMIT:]
+    return '', text
+
+# 语音回复：按句子分段并行合成，按顺序在每段完成后立即发送
+class VoiceResponder:
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, voice: str):
+        self.update = update
+        self.context = context
+        self.voice = voice
+        self._buffer = ''
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._synth_tasks: list = []
+        self._sender = asyncio.create_task(self._send_in_order())
+
+    def feed(self, text: str) -> None:
+        self._buffer += text
+        while True:
+            chunk, self._buffer = split_speech_chunk(self._buffer, Config.TTS_CHUNK_CHARS)
+            if not chunk:
+                break
+            self._submit(chunk)
+
+    def _submit(self, chunk: str) -> None:
+        if not chunk.strip():
+            return
+        task = asyncio.create_task(synthesize_speech(
+            self.update.effective_user.id, chunk, self.voice,
+            request_priority(self.update.effective_user.id, self.update.effective_chat.id)
+        ))
+        self._synth_tasks.append(task)
+        self._queue.put_nowait(task)
+
+    async def _send_in_order(self) -> None:
+        while True:
+            task = await self._queue.get()
+            if task is None:
+                return
+            speech = await task
+            # python-telegram-bot 会一次性读入整个文件，并且无法从没有文件名的 SpooledTemporaryFile 推断文件名，直接传入内容
+            with speech:
+                await self.context.bot.send_voice(
+                    chat_id=self.update.effective_chat.id,
+                    voice=speech.read(),
+                    filename='voice.mp3'
+                )
+
+    async def finish(self) -> None:
+        while self._buffer:
+            chunk, self._buffer = split_speech_chunk(self._buffer, Config.TTS_CHUNK_CHARS, final=True)
+            self._submit(chunk)
+        self._queue.put_nowait(None)
+        try:
+            await self._sender
+        except Exception as e:
+            record_error('voice_response', e)
+            self.cancel()
+            await self.update.message.reply_text('抱歉，生成语音回复时发生了错误。')
+
+    def cancel(self) -> None:
+        self._sender.cancel()
+        for task in self._synth_tasks:
+            task.cancel()
+            task.add_done_callback(self._close_unsent)
+
+    # 已合成但未发送的音频缓冲区需要关闭
+    @staticmethod
+    def _close_unsent(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is None:
+            task.result().close()
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+# Markdown转Telegram HTML：逐行增量渲染并记住代码块状态，按行切分为多条消息，每条消息的标签都是闭合的
+FENCE_CLOSE = '</code></pre>'
+INLINE_TOKEN_PATTERN = re.compile(r'(`[^`\n]+`|\[[^\]\n]+\]\(https?://[^\s)"]+\))')
+LINK_PATTERN = re.compile(r'\[([^\]\n]+)\]\((https?://[^\s)"]+)\)')
+EMPHASIS_PATTERNS = (
+    (re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*'), r'<b>\1</b>'),
+    (re.compile(r'__(?=\S)(.+?)(?<=\S)__'), r'<b>\1</b>'),
+    (re.compile(r'(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])'), r'<i>\1</i>'),
+    (re.compile(r'(?<![\w_])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![\w_])'), r'<i>\1</i>'),
+    (re.compile(r'~~(?=\S)(.+?)(?<=\S)~~'), r'<s>\1</s>'),
+)
+HEADING_PATTERN = re.compile(r'^\s{0,3}#{1,6}\s+(.*?)[\s#]*$')
+BULLET_PATTERN = re.compile(r'^(\s*)[-*+]\s+')
+
+def escape_html(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+EMPHASIS_TAG_PATTERN = re.compile(r'<(/?)([bis])>')
+
+# 交叉的强调（如 **a _b** c_）会生成交错的标签：关闭外层标签前先关闭内层的标签，之后再重新打开
+def nest_emphasis_tags(html_text: str) -> str:
+    parts = []
+    stack = []
+    last = 0
+    for match in EMPHASIS_TAG_PATTERN.finditer(html_text):
+        parts.append(html_text[last:match.start()])
+        last = match.end()
+        closing, tag = match.groups()
+        if not closing:
+            stack.append(tag)
+            parts.append(match.group())
+            continue
+        index = len(stack) - 1 - stack[::-1].index(tag)
+        inner = stack[index + 1:]
+        del stack[index:]
+        parts.append(''.join(f'</{t}>' for t in reversed(inner)) + match.group() + ''.join(f'<{t}>' for t in inner))
+        stack.extend(inner)
+    parts.append(html_text[last:])
+    return ''.join(parts)
+
+def format_emphasis(escaped: str) -> str:
+    for pattern, replacement in EMPHASIS_PATTERNS:
+        escaped = pattern.sub(replacement, escaped)
+    return nest_emphasis_tags(escaped)
+
+def render_inline(line: str) -> str:
+    parts = []
+    for i, token in enumerate(INLINE_TOKEN_PATTERN.split(line)):
+        if i % 2 == 0:
+            parts.append(format_emphasis(escape_html(token)))
+        elif token[0] == '`':
+            parts.append(f'<code>{escape_html(token[1:-1])}</code>')
+        else:
+            link = LINK_PATTERN.match(token)
+            parts.append(f'<a href="{escape_html(link.group(2))}">{format_emphasis(escape_html(link.group(1)))}</a>')
+    return ''.join(parts)
+
+def render_markdown_line(line: str) -> str:
+    heading = HEADING_PATTERN.match(line)
+    if heading:
+        return f'<b>{render_inline(heading.group(1))}</b>'
+    bullet = BULLET_PATTERN.match(line)
+    if bullet:
+        return bullet.group(1) + '• ' + render_inline(line[bullet.end():])
+    return render_inline(line)
+
+# 在不超过limit的前提下，尽量在换行或空格处切分文本
+def split_message_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> Tuple[str, str]:
+    if len(text) <= limit:
+        return text, ''
+    cut = text.rfind('\n', 0, limit)
+    if cut < limit // 2:
+        cut = text.rfind(' ', 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    return text[:cut], text[cut:].lstrip('\n')
+
+class FormattedChunk:
+    __slots__ = ('html', 'plain', 'fence_open', 'after_tag')
+
+    def __init__(self, fence_tag: Optional[str] = None):
+        # 代码块跨消息时，新消息以重新打开的标签开头
+        self.html = fence_tag or ''
+        self.plain = ''
+        self.fence_open = fence_tag is not None
+        # 刚写入代码块开始标签，下一行直接接在标签后面
+        self.after_tag = fence_tag is not None
+
+class TelegramFormatter:
+    def __init__(self, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        # 预留关闭代码块标签的空间
+        self.room = limit - len(FENCE_CLOSE)
+        self.fence_tag: Optional[str] = None
+        # 还没收到换行的最后一行
+        self.pending = ''
+        self.chunks = [FormattedChunk()]
+
+    def feed(self, text: str) -> None:
+        self.pending += text
+        if '\n' in text:
+            *lines, self.pending = self.pending.split('\n')
+            for line in lines:
+                self._add_line(line)
+        # 很长且没有换行的文本：提前在空格处切出，避免一行超过消息长度上限
+        while len(self.pending) > self.room // 2:
+            head, self.pending = split_message_text(self.pending, self.room // 2)
+            self._add_line(head)
+
+    def finish(self) -> None:
+        if self.pending:
+            self._add_line(self.pending)
+            self.pending = ''
+
+    def _add_line(self, line: str) -> None:
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            if self.fence_tag is None:
+                lang = stripped[3:].strip()
+                fence_tag = f'<pre><code class="language-{escape_html(lang)}">' if lang else '<pre><code>'
+                # 先预留空间再进入代码块：开始标签本身导致换到新消息时，新消息不能再以重新打开的标签开头
+                chunk = self._reserve(len(fence_tag) + 1, line)
+                self.fence_tag = fence_tag
+                chunk.html += ('\n' if chunk.html else '') + fence_tag
+                chunk.fence_open = chunk.after_tag = True
+            else:
+                self.fence_tag = None
+                chunk = self.chunks[-1]
+                chunk.html += FENCE_CLOSE
+                chunk.fence_open = chunk.after_tag = False
+            chunk.plain += ('\n' if chunk.plain else '') + line
+            return
+
+        # 超长的行按与 feed 相同的规则切开，保证一次性格式化和流式格式化的结果一致
+        while len(line) > self.room // 2:
+            head, line = split_message_text(line, self.room // 2)
+            self._add_text(head)
+        self._add_text(line)
+
+    def _add_text(self, line: str) -> None:
+        html_line = escape_html(line) if self.fence_tag is not None else render_markdown_line(line)
+        if len(html_line) >= self.room:
+            # 转义后仍然超长（例如大量 & 符号）：放弃格式，按转义后的长度硬切
+            size = max(1, self.room // 5)
+            for start in range(0, len(line), size):
+                self._append(escape_html(line[start:start + size]), line[start:start + size])
+            return
+        self._append(html_line, line)
+
+    def _append(self, html_line: str, line: str) -> None:
+        chunk = self._reserve(len(html_line) + 1, line)
+        chunk.html += ('' if chunk.after_tag or not chunk.html else '\n') + html_line
+        chunk.plain += ('\n' if chunk.plain else '') + line
+        chunk.after_tag = False
+
+    # 当前消息放不下时开始新的消息，代码块在新消息中重新打开
+    def _reserve(self, size: int, line: str) -> FormattedChunk:
+        chunk = self.chunks[-1]
+        if chunk.plain and len(chunk.html) + size > self.room:
+            chunk = FormattedChunk(self.fence_tag)
+            self.chunks.append(chunk)
+        return chunk
+
+    # 第index条消息的 (HTML, 纯文本)；with_pending=True 时在最后一条中附上未完成的一行
+    def render(self, index: int, with_pending: bool = False) -> Tuple[str, str]:
+        chunk = self.chunks[index]
+        html_text, plain = chunk.html, chunk.plain
+        if with_pending and self.pending and index == len(self.chunks) - 1:
+            line = escape_html(self.pending) if self.fence_tag is not None else render_markdown_line(self.pending)
+            sep = '' if chunk.after_tag or not html_text else '\n'
+            if len(html_text) + len(sep) + len(line) <= self.room:
+                html_text += sep + line
+                plain += ('\n' if plain else '') + self.pending
+        return html_text + (FENCE_CLOSE if chunk.fence_open else ''), plain
+
+def format_reply(text: str) -> list:
+    formatter = TelegramFormatter()
+    formatter.feed(text)
+    formatter.finish()
+    return [formatter.render(i) for i in range(len(formatter.chunks))]
+
+def is_parse_error(error: BadRequest) -> bool:
+    return 'parse entities' in str(error).lower()
+
+# 发送一条格式化的消息，HTML解析失败时这一条退回纯文本
+async def deliver_formatted(send: Callable[..., Awaitable[Any]], html_text: str, plain: str) -> Any:
+    try:
+        return await send(text=html_text, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if not is_parse_error(e):
+            raise
+        return await send(text=plain)
+
+# 非流式回答：第一条编辑"正在处理"消息（message_id 为None时作为新消息发送），超过长度上限的部分作为新消息发送
+async def send_formatted_reply(bot: Any, chat_id: int, message_id: Optional[int], text: str) -> None:
+    for i, (html_text, plain) in enumerate(format_reply(text)):
+        if i == 0 and message_id is not None:
+            await deliver_formatted(functools.partial(bot.edit_message_text, chat_id=chat_id, message_id=message_id), html_text, plain)
+        else:
+            await deliver_formatted(functools.partial(bot.send_message, chat_id=chat_id), html_text, plain)
+
+# 流式消息：增量格式化并按自适应的频率编辑消息，超过长度上限时续写到新消息
+class StreamingMessage:
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message: Message, started: float):
+        self.bot = context.bot
+        self.chat_id = chat_id
+        self.message_id = message.message_id
+        self.started = started
+        self.min_interval = Config.STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else Config.STREAM_EDIT_INTERVAL
+        self.interval = self.min_interval
+        self.formatter = TelegramFormatter()
+        # 当前正在编辑的消息对应的分块
+        self.index = 0
+        self.shown_text = ''
+        self.last_edit = 0.0
+        self.first_visible = False
+
+    async def append(self, delta: str) -> None:
+        self.formatter.feed(delta)
+        while self.index < len(self.formatter.chunks) - 1:
+            await self._finalize()
+            await self._next_message()
+        if time.monotonic() - self.last_edit >= self.interval:
+            await self._edit(*self.formatter.render(self.index, with_pending=True))
+
+    async def finish(self) -> None:
+        self.formatter.finish()
+        await self._finalize()
+        while self.index < len(self.formatter.chunks) - 1:
+            await self._next_message()
+            await self._finalize()
+
+    async def _next_message(self) -> None:
+        self.index += 1
+        new_message = await self.bot.send_message(chat_id=self.chat_id, text='...')
+        self.message_id = new_message.message_id
+        self.shown_text = ''
+
+    async def _edit(self, html_text: str, plain: str) -> bool:
+        if not plain.strip() or html_text == self.shown_text:
+            return True
+        self.last_edit = time.monotonic()
+        try:
+            await deliver_formatted(
+                functools.partial(self.bot.edit_message_text, chat_id=self.chat_id, message_id=self.message_id),
+                html_text,
+                plain
+            )
+        except RetryAfter as e:
+            # 触发Telegram频率限制：放慢编辑频率，等待下一次合并后的编辑
+            self.interval = max(self.interval * 2, retry_after_seconds(e))
+            return False
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        self.shown_text = html_text
+        self.interval = max(self.min_interval, self.interval * 0.8)
+        if not self.first_visible:
+            self.first_visible = True
+            ttft = time.monotonic() - self.started
+            first_token_latency.observe(ttft)
+            logger.debug('首个可见token延迟: %.3fs (chat %s)', ttft, self.chat_id)
+        return True
+
+    # 当前消息的最终版本一定要发出去，遇到频率限制时等待后重试
+    async def _finalize(self) -> None:
+        while not await self._edit(*self.formatter.render(self.index)):
+            await asyncio.sleep(self.interval)
+
+async def stream_response(update: Update, context: ContextTypes.DEFAULT_TYPE, processing_message: Message, model: str, session: ChatSession, started: float, voice_responder: Optional[VoiceResponder] = None) -> str:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    streaming_message = StreamingMessage(context, chat_id, processing_message, started)
+    parts = []
+    deltas = stream_gpt_response(user_id, model, session, priority=request_priority(user_id, chat_id))
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            if voice_responder is not None:
+                voice_responder.feed(delta)
+            await streaming_message.append(delta)
+    finally:
+        # 出错或被取消时立即关闭生成器，不等垃圾回收，让它及时停止读流
+        await deltas.aclose()
+    await streaming_message.finish()
+    return ''.join(parts)
+
+# 回答缓存：以模型和规范化后的消息列表为key，按TTL和容量淘汰
+class ResponseCache:
+    def __init__(self, enabled: bool, max_entries: int, ttl: float):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (过期时间, 回答)
+        self._entries: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(model: str, messages: list) -> str:
+        # 忽略首尾空白和连续空白的差异
+        normalized = [(m['role'], ' '.join((m['content'] or '').split())) for m in messages]
+        payload = json.dumps([model, normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, response: str) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+response_cache = ResponseCache(Config.RESPONSE_CACHE_ENABLED, Config.RESPONSE_CACHE_SIZE, Config.RESPONSE_CACHE_TTL)
+metrics.counter('response_cache_hits_total', '回答缓存命中次数', lambda: response_cache.hits)
+metrics.counter('response_cache_misses_total', '回答缓存未命中次数', lambda: response_cache.misses)
+metrics.gauge('response_cache_entries', '回答缓存条目数', lambda: len(response_cache))
+
+# use_cache=False 时总是重新生成（例如 /redo）
+async def get_gpt_response(user_id: int, model: str, session: ChatSession, use_cache: bool = True, priority: int = PRIORITY_GROUP) -> str:
+    messages = session.build_prompt(model, user_id)
+    cache_key = response_cache.make_key(model, messages) if use_cache and response_cache.enabled else None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    async with openai_limiter.slot(user_id, priority):
+        with stage_latency.time(stage='chat_completion'):
+            start = time.monotonic()
+            response = await openai_request('chat', model, lambda client: client.chat.completions.create(
+                model=model,
+                messages=messages
+            ))
+            model_fallback.record(model, 'chat', time.monotonic() - start)
+    content = response.choices[0].message.content
+    if response.usage is not None:
+        record_token_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+    if cache_key is not None:
+        response_cache.put(cache_key, content)
+    return content
+
+async def stream_gpt_response(user_id: int, model: str, session: ChatSession, use_cache: bool = True, priority: int = PRIORITY_GROUP) -> AsyncIterator[str]:
+    messages = session.build_prompt(model, user_id)
+    cache_key = response_cache.make_key(model, messages) if use_cache and response_cache.enabled else None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+    # 内容片段，None 表示流结束，异常表示请求失败
+    deltas: asyncio.Queue = asyncio.Queue()
+
+    # 在并发名额内只负责读流：调用方编辑 Telegram 消息（包括 RetryAfter 退避和发送续写消息）时不占用 OpenAI 名额
+    async def receive() -> None:
+        try:
+            async with openai_limiter.slot(user_id, priority):
+                with stage_latency.time(stage='chat_completion_stream'):
+                    start = time.monotonic()
+                    # 只在收到第一段内容之前重试；流式请求不发对冲请求
+                    stream = await openai_request('stream', model, lambda client: client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        stream=True
+                    ), hedge=False)
+                    # 读完或被取消时关闭流，释放连接
+                    async with stream:
+                        first = True
+                        async for chunk in stream:
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                if first:
+                                    model_fallback.record(model, 'first_token', time.monotonic() - start)
+                                    first = False
+                                deltas.put_nowait(chunk.choices[0].delta.content)
+        except Exception as e:
+            deltas.put_nowait(e)
+        else:
+            deltas.put_nowait(None)
+
+    parts = []
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            delta = await deltas.get()
+            if delta is None:
+                break
+            if isinstance(delta, Exception):
+                raise delta
+            parts.append(delta)
+            yield delta
+    finally:
+        # 调用方出错或生成被取消时停止读流
+        receiver.cancel()
+    content = ''.join(parts)
+    # 流式响应不返回用量，按本地计数记录
+    record_token_usage(model, session.total_tokens + session.summary_tokens, count_tokens(content, model))
+    if cache_key is not None:
+        response_cache.put(cache_key, content)
+
+redo_prefetch_results = metrics.counter('redo_prefetch_total', '/redo 预取的结果：hit（已生成）、inflight（生成中）、miss、cancelled、skipped（超出预算）、error')
+
+# /redo 预取：为用过 /redo 的用户在每次回答后预先生成一个备选回答，/redo 时如果会话没有变化就直接使用；
+# 会话继续（收到新消息）时取消。按会话最后一条回答判断预取结果是否仍然有效
+class RedoPrefetcher:
+    def __init__(self, enabled: bool, max_inflight: int, hourly_tokens: int, user_window: float):
+        self.enabled = enabled
+        self.max_inflight = max_inflight
+        self.hourly_tokens = hourly_tokens
+        self.user_window = user_window
+        # session_key -> (生成时会话的最后一条消息, 模型, 任务)
+        self._prefetches: Dict[str, Tuple[dict, str, asyncio.Task]] = {}
+        self._redo_users: Dict[int, float] = {}
+        self._tokens_used = 0
+        self._budget_reset = time.monotonic() + 3600
+        self.inflight = 0
+
+    def record_redo(self, user_id: int) -> None:
+        now = time.monotonic()
+        self._redo_users[user_id] = now
+        if len(self._redo_users) > 10000:
+            self._redo_users = {u: t for u, t in self._redo_users.items() if now - t <= self.user_window}
+
+    def _within_budget(self) -> bool:
+        now = time.monotonic()
+        if now >= self._budget_reset:
+            self._tokens_used = 0
+            self._budget_reset = now + 3600
+        return self.inflight < self.max_inflight and self._tokens_used < self.hourly_tokens
+
+    # 回答保存到会话之后调用
+    def schedule(self, session_key: str, user_id: int, model: str, session: ChatSession) -> None:
+        if not self.enabled:
+            return
+        last_redo = self._redo_users.get(user_id)
+        if last_redo is None or time.monotonic() - last_redo > self.user_window:
+            return
+        self.cancel(session_key)
+        if not self._within_budget():
+            redo_prefetch_results.inc(result='skipped')
+            return
+        # 去掉最后一条回答，就是 /redo 时发送的消息
+        prompt = session.build_prompt(model, user_id)[:-1]
+        task = asyncio.create_task(self._generate(user_id, model, prompt))
+        task.add_done_callback(self._on_done)
+        self._prefetches[session_key] = (session.messages[-1], model, task)
+        # 不再使用的会话中已完成的预取：超过上限时丢弃最早的
+        if len(self._prefetches) > 10000:
+            self.cancel(next(iter(self._prefetches)))
+
+    async def _generate(self, user_id: int, model: str, prompt: list) -> str:
+        self.inflight += 1
+        try:
+            async with openai_limiter.slot(user_id, PRIORITY_BACKGROUND):
+                with stage_latency.time(stage='redo_prefetch'):
+                    response = await openai_request('chat', model, lambda client: client.chat.completions.create(
+                        model=model,
+                        messages=prompt
+                    ))
+        finally:
+            self.inflight -= 1
+        if response.usage is not None:
+            record_token_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+            self._tokens_used += response.usage.total_tokens
+        return response.choices[0].message.content
+
+    @staticmethod
+    def _on_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            record_error('redo_prefetch', task.exception())
+
+    def cancel(self, session_key: str) -> None:
+        entry = self._prefetches.pop(session_key, None)
+        if entry is not None and not entry[2].done():
+            entry[2].cancel()
+            redo_prefetch_results.inc(result='cancelled')
+
+    # /redo 时调用（在移除最后一条回答之前）：返回仍然有效的预取任务（可能还在生成中），没有则返回None
+    def take(self, session_key: str, session: ChatSession, model: str) -> Optional[asyncio.Task]:
+        if not self.enabled:
+            return None
+        entry = self._prefetches.pop(session_key, None)
+        if entry is None:
+            redo_prefetch_results.inc(result='miss')
+            return None
+        anchor, prefetch_model, task = entry
+        failed = task.done() and (task.cancelled() or task.exception() is not None)
+        if failed or anchor is not session.messages[-1] or prefetch_model != model:
+            if not task.done():
+                task.cancel()
+            redo_prefetch_results.inc(result='error' if failed else 'miss')
+            return None
+        redo_prefetch_results.inc(result='hit' if task.done() else 'inflight')
+        return task
+
+redo_prefetcher = RedoPrefetcher(Config.REDO_PREFETCH, Config.REDO_PREFETCH_MAX_INFLIGHT, Config.REDO_PREFETCH_HOURLY_TOKENS, Config.REDO_PREFETCH_USER_WINDOW)
+metrics.gauge('redo_prefetch_inflight', '正在进行的 /redo 预取数', lambda: redo_prefetcher.inflight)
+
+# 把被裁剪掉的旧消息（连同之前的摘要）总结成一段简短的摘要
+async def summarize_messages(user_id: int, model: str, previous_summary: Optional[str], messages: list) -> str:
+    transcript = '\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f'已有摘要：{previous_summary}\n\n{transcript}'
+    async with openai_limiter.slot(user_id, PRIORITY_BACKGROUND):
+        with stage_latency.time(stage='summarize'):
+            response = await openai_request('chat', model, lambda client: client.chat.completions.create(
+                model=model,
+                messages=[
+                    {'role': 'system', 'content': '请用简洁的语言总结以下对话的要点，保留后续对话需要的关键信息。'},
+                    {'role': 'user', 'content': transcript},
+                ]
+            ))
+    return response.choices[0].message.content
+
+# 绘图任务队列：/draw 只负责提交任务，由固定数量的后台worker生成图像，不占用更新处理
+DALLE_SIZES = ('1024x1024', '1792x1024', '1024x1792')
+
+def parse_draw_args(args: list) -> Tuple[int, str, str]:
+    n, size = 1, DALLE_SIZES[0]
+    words = list(args)
+    while words and '=' in words[0]:
+        name, _, value = words.pop(0).partition('=')
+        if name == 'n' and value.isdigit() and 1 <= int(value) <= Config.DRAW_MAX_IMAGES:
+            n = int(value)
+        elif name == 'size' and value in DALLE_SIZES:
+            size = value
+        else:
+            raise ValueError(f'无效的参数: {name}={value}')
+    return n, size, ' '.join(words)
+
+class DrawJob:
+    def __init__(self, user_id: int, chat_id: int, prompt: str, n: int, size: str, bot: Any):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.prompt = prompt
+        self.n = n
+        self.size = size
+        self.bot = bot
+        self.message_id: Optional[int] = None
+        self.key = (chat_id, ' '.join(prompt.lower().split()), n, size)
+        self.task: Optional[asyncio.Task] = None
+        self.started = False
+        self.cancelled = False
+        self.done = asyncio.Event()
+
+    async def edit(self, text: str) -> None:
+        try:
+            await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
+        except BadRequest:
+            pass
+
+class DrawQueue:
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+        # 同一聊天中相同的提示（包括排队中和生成中的）只保留一个任务
+        self.inflight: Dict[tuple, DrawJob] = {}
+        self.running = 0
+        # 已预留但还没开始生成的任务数（包括还在准入控制中等待、尚未提交的任务；已取消的任务不计入）
+        self.waiting = 0
+        self._stopping = False
+
+    def queued(self) -> int:
+        return self.waiting
+
+    # 检查和 reserve 之间没有 await，预留的任务立即计入，并发的 /draw 不会超出上限
+    def full(self) -> bool:
+        return self.waiting >= self.max_size
+
+    # 刚预留的任务前面还有多少个任务要先完成
+    def ahead(self) -> int:
+        return max(0, self.waiting + self.running - self.workers)
+
+    def reserve(self, job: DrawJob) -> Optional[DrawJob]:
+        existing = self.inflight.get(job.key)
+        if existing is None:
+            self.inflight[job.key] = job
+            self.waiting += 1
+        return existing
+
+    def release(self, job: DrawJob) -> None:
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+            if not job.started:
+                self.waiting -= 1
+        job.done.set()
+
+    def submit(self, job: DrawJob) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._queue.put_nowait(job)
+
+    def cancel(self, user_id: int, chat_id: int) -> list:
+        jobs = [job for job in self.inflight.values() if job.user_id == user_id and job.chat_id == chat_id]
+        for job in jobs:
+            job.cancelled = True
+            self.release(job)
+            if job.task is not None:
+                job.task.cancel()
+        return jobs
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.cancelled:
+                    continue
+                job.started = True
+                self.waiting -= 1
+                self.running += 1
+                job.task = asyncio.ensure_future(self._run(job))
+                try:
+                    await job.task
+                except asyncio.CancelledError:
+                    # 关闭时 worker 自己被取消，即使任务刚好也被取消了也要退出
+                    if not job.cancelled or self._stopping:
+                        raise
+                except Exception as e:
+                    record_error('draw', e)
+                    await job.edit(f"抱歉，生成图像时发生了错误: {str(e)}。请稍后再试。")
+                finally:
+                    self.running -= 1
+            finally:
+                self.release(job)
+                self._queue.task_done()
+
+    async def _run(self, job: DrawJob) -> None:
+        await job.edit("正在生成图像，请稍候...")
+        progress = asyncio.ensure_future(self._progress(job))
+        # dall-e-3 每次只能生成一张，n>1 时并行发出多个请求
+        requests = [asyncio.ensure_future(self._generate(job)) for _ in range(job.n)]
+        try:
+            with stage_latency.time(stage='image_generation'):
+                urls = await asyncio.gather(*requests)
+        finally:
+            progress.cancel()
+            for request in requests:
+                request.cancel()
+        if job.n == 1:
+            await job.bot.send_photo(chat_id=job.chat_id, photo=urls[0], caption=job.prompt[:1024])
+        else:
+            media = [InputMediaPhoto(url, caption=job.prompt[:1024] if i == 0 else None) for i, url in enumerate(urls)]
+            await job.bot.send_media_group(chat_id=job.chat_id, media=media)
+        await job.bot.delete_message(chat_id=job.chat_id, message_id=job.message_id)
+
+    async def _generate(self, job: DrawJob) -> str:
+        async with openai_limiter.slot(job.user_id, request_priority(job.user_id, job.chat_id)):
+            # 绘图按张计费，不发对冲请求
+            response = await openai_request('image', 'dall-e-3', lambda client: client.images.generate(
+                model="dall-e-3",
+                prompt=job.prompt,
+                size=job.size,
+                quality="hd",
+                n=1,
+            ), hedge=False)
+        if not response or not response.data:
+            raise ValueError("Invalid response structure from DALL-E API")
+        if not response.data[0].url:
+            raise ValueError("Image URL is None")
+        return response.data[0].url
+
+    async def _progress(self, job: DrawJob) -> None:
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(Config.DRAW_PROGRESS_INTERVAL)
+            if job.cancelled:
+                return
+            await job.edit(f"正在生成图像，已用时 {int(time.monotonic() - started)} 秒...（/cancel_draw 取消）")
+
+    async def shutdown(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._stopping = False
+
+draw_queue = DrawQueue(Config.DRAW_WORKERS, Config.DRAW_QUEUE_SIZE)
+metrics.gauge('draw_jobs_queued', '排队中的绘图任务数', draw_queue.queued)
+metrics.gauge('draw_jobs_running', '正在生成的绘图任务数', lambda: draw_queue.running)
 
 async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -458,38 +3137,48 @@ async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text('抱歉，您没有使用权限。')
         return
 
-    if not context.args:
+    try:
+        n, size, prompt = parse_draw_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f'{e}。用法: /draw [n=1-{Config.DRAW_MAX_IMAGES}] [size={"|".join(DALLE_SIZES)}] <提示>')
+        return
+
+    if not prompt:
         await update.message.reply_text('请提供绘画提示。')
         return
 
-    prompt = ' '.join(context.args)
-    processing_message = await update.message.reply_text("正在生成图像，请稍候...")
+    if draw_queue.full():
+        await update.message.reply_text('绘画任务太多，请稍后再试。')
+        return
+
+    job = DrawJob(user_id, chat_id, prompt, n, size, context.bot)
+    if draw_queue.reserve(job) is not None:
+        await update.message.reply_text('相同的绘画请求正在处理中，请稍候。')
+        return
 
     try:
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="high-quality",
-            n=1,
+        # 每张图片占用一次配额
+        if not await admit_request(update, *(['image'] * n)):
+            draw_queue.release(job)
+            return
+        ahead = draw_queue.ahead()
+        processing_message = await update.message.reply_text(
+            f"已加入绘画队列，前面还有 {ahead} 个任务。" if ahead else "正在生成图像，请稍候..."
         )
+    except BaseException:
+        draw_queue.release(job)
+        raise
+    job.message_id = processing_message.message_id
+    draw_queue.submit(job)
 
-        if response and response.data and len(response.data) > 0:
-            image_url = response.data[0].url
-            if image_url:
-                await context.bot.send_photo(chat_id=chat_id, photo=image_url)
-                await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-            else:
-                raise ValueError("Image URL is None")
-        else:
-            raise ValueError("Invalid response structure from DALL-E API")
-
-    except Exception as e:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=processing_message.message_id,
-            text=f"抱歉，生成图像时发生了错误: {str(e)}。请稍后再试。"
-        )
+async def cancel_draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    jobs = draw_queue.cancel(update.effective_user.id, update.effective_chat.id)
+    if not jobs:
+        await update.message.reply_text('没有进行中的绘画任务。')
+        return
+    for job in jobs:
+        await job.edit("已取消绘画任务。")
+    await update.message.reply_text(f'已取消 {len(jobs)} 个绘画任务。')
 
 async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -502,43 +3191,294 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text('请在 /chat 命令后输入您的消息。')
         return
 
+    if not await admit_request(update, 'chat'):
+        return
+
     message = ' '.join(context.args)
     session_key = get_session_key(user_id, chat_id)
-    user_sessions[session_key] = [{'role': 'user', 'content': message}]
+    async with session_locks.lock(session_key):
+        session = user_sessions.new(session_key)
+        session.append('user', message)
+        requested_model = get_effective_settings(user_id, chat_id).model
+        if chat_id < 0:
+            session.group_context = group_contexts.build_context(chat_id, requested_model)
+            group_contexts.record(chat_id, update.message.message_id, update.effective_user.full_name, message)
 
-    processing_message = await update.message.reply_text("正在处理您的请求，请稍候...")
+        processing_message = await update.message.reply_text("正在处理您的请求，请稍候...")
+        model = await model_fallback.choose(requested_model)
 
-    try:
-        response = get_gpt_response(user_id, chat_id, user_sessions[session_key])
-        user_sessions[session_key].append({'role': 'assistant', 'content': response})
-        
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=processing_message.message_id,
-            text=response,
-            parse_mode=ParseMode.MARKDOWN
-        )
-    except Exception as e:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=processing_message.message_id,
-            text="抱歉，处理您的请求时发生了错误。请稍后再试。"
-        )
+        try:
+            response = await session_locks.run_generation(
+                session_key,
+                get_gpt_response(user_id, model, session, priority=request_priority(user_id, chat_id))
+            )
+            session.append('assistant', response)
+            await user_sessions.save(session_key)
+            redo_prefetcher.schedule(session_key, user_id, model, session)
+            if chat_id < 0:
+                group_contexts.record(chat_id, processing_message.message_id, '机器人', response)
+
+            await send_formatted_reply(context.bot, chat_id, processing_message.message_id, response)
+        except GenerationCancelled:
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=processing_message.message_id,
+                text="已取消：收到了新的消息。"
+            )
+            return
+        except Exception as e:
+            record_error('chat_command', e)
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=processing_message.message_id,
+                text="抱歉，处理您的请求时发生了错误。请稍后再试。"
+            )
+            return
+
+    await notify_fallback(update, requested_model, model)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != Config.ADMIN_ID:
+        await update.message.reply_text('只有管理员可以查看统计信息。')
+        return
+
+    uptime = int(time.time() - STARTED_AT)
+    clients = await get_openai_clients_async()
+    lines = [
+        f'运行时间: {uptime // 3600}小时{uptime % 3600 // 60}分钟',
+        f'会话数: {len(user_sessions)}（约 {user_sessions.total_bytes / 1024 / 1024:.1f} MB）',
+        f'排队: OpenAI {openai_limiter.waiting}，准入控制 {admission.queued}，进行中的OpenAI请求 {openai_limiter.active}',
+        f'回答缓存: 命中 {response_cache.hits}，未命中 {response_cache.misses}',
+        '准入控制拒绝: ' + '，'.join(f'{kind} {count}' for kind, count in admission.rejected.items()),
+        '上游: ' + '，'.join(
+            f'{u.name} 进行中 {u.outstanding}' + ('（熔断）' if u.open_until > time.monotonic() else '')
+            for u in clients.upstreams
+        ),
+    ]
+    if Config.WORKER_COUNT > 1:
+        lines.append(f'工作进程: {Config.WORKER_ID}（共 {Config.WORKER_COUNT} 个），转发出的更新 {int(sum(forwarded_updates.values.values()))}')
+    if model_fallback.enabled:
+        lines.append('模型降级: ' + ('，'.join(
+            f"{dict(key)['model']} -> {dict(key)['fallback']} {int(value)}" for key, value in model_fallbacks.values.items()
+        ) or '无'))
+    if redo_prefetcher.enabled:
+        results = {dict(key)['result']: int(value) for key, value in redo_prefetch_results.values.items()}
+        lines.append('/redo 预取: ' + '，'.join(f'{result} {count}' for result, count in sorted(results.items())) + f'，进行中 {redo_prefetcher.inflight}')
+    lines += ['', '各阶段耗时 (p50 / p99 / 次数):']
+    for histogram in (stage_latency, telegram_latency, first_token_latency, openai_queue_wait):
+        for key, (_, _, total) in sorted(histogram.values.items()):
+            name = ','.join(v for _, v in key) or histogram.name
+            lines.append(f'  {name}: {histogram.quantile(0.5, key)}s / {histogram.quantile(0.99, key)}s / {total}')
+    tokens = {}
+    for key, value in tokens_total.values.items():
+        labels = dict(key)
+        tokens[labels['model']] = tokens.get(labels['model'], 0) + int(value)
+    if tokens:
+        lines.append('')
+        lines.append('Token用量: ' + '，'.join(f'{model} {count}' for model, count in tokens.items()))
+    if errors_total.values:
+        lines.append('')
+        lines.append('错误: ' + '，'.join(f"{dict(key)['where']}/{dict(key)['type']} {int(value)}" for key, value in errors_total.values.items()))
+    await update.message.reply_text('\n'.join(lines))
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 不做任何响应
     pass
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    pass
+    record_error('error_handler', context.error)
+
+# 记录开启了群聊上下文的群中的文字消息（在其他处理器之前运行，不影响它们）
+async def record_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.message
+    if message is None or not group_contexts.capacity(update.effective_chat.id):
+        return
+    name = message.from_user.full_name if message.from_user else '匿名'
+    group_contexts.record(update.effective_chat.id, message.message_id, name, message.text or message.caption or '')
+
+async def group_context_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    if chat_id >= 0:
+        await update.message.reply_text('群聊上下文只能在群组中使用。')
+        return
+
+    if not context.args:
+        capacity = group_contexts.capacity(chat_id)
+        await update.message.reply_text(f'群聊上下文已开启，保留最近 {capacity} 条消息。' if capacity else '群聊上下文未开启。')
+        return
+
+    if user_id != Config.ADMIN_ID:
+        member = await context.bot.get_chat_member(chat_id, user_id)
+        if member.status not in ('administrator', 'creator'):
+            await update.message.reply_text('只有群管理员可以更改群聊上下文设置。')
+            return
+
+    action = context.args[0].lower()
+    if action == 'off':
+        group_contexts.disable(chat_id)
+        await update.message.reply_text('群聊上下文已关闭，已记录的消息已清除。')
+        return
+    if action != 'on':
+        await update.message.reply_text('用法: /group_context [on [条数]|off]')
+        return
+    capacity = Config.GROUP_CONTEXT_DEFAULT_MESSAGES
+    if len(context.args) > 1:
+        if not context.args[1].isdigit() or not 1 <= int(context.args[1]) <= Config.GROUP_CONTEXT_MAX_MESSAGES:
+            await update.message.reply_text(f'条数必须在 1 到 {Config.GROUP_CONTEXT_MAX_MESSAGES} 之间。')
+            return
+        capacity = int(context.args[1])
+    group_contexts.enable(chat_id, capacity)
+    reply = f'群聊上下文已开启：之后的消息会保留最近 {capacity} 条，/chat 和回复机器人时作为上下文使用。'
+    # 开启了隐私模式（BotFather 的默认设置）且不是群管理员时，机器人只能收到命令和回复它的消息，普通群消息不会被记录
+    if not context.bot.can_read_all_group_messages:
+        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
+        if bot_member.status not in ('administrator', 'creator'):
+            reply += (
+                '\n\n注意：机器人开启了群组隐私模式，收不到普通的群消息，群聊上下文只会记录命令和回复机器人的消息。'
+                '请在 BotFather 中用 /setprivacy 关闭隐私模式（之后需要把机器人移出群组再重新加入），或者把机器人设为群管理员。'
+            )
+    await update.message.reply_text(reply)
 
 async def group_chat_created(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     result = update.chat_member
     if result.new_chat_member.status == "member" and result.new_chat_member.user.id == context.bot.id:
         await update.effective_chat.send_message("感谢将我添加到群组!使用 /help 查看可用命令。")
 
-def main() -> None:
-    application = Application.builder().token(Config.TOKEN).build()
+# 会触发新回答的消息：/chat、/redo，以及机器人会回复的普通消息和语音（群组中只有回复机器人的消息）
+def starts_new_generation(update: Update, bot_id: int) -> bool:
+    message = update.message
+    if message is None:
+        return False
+    text = message.text or ''
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0] in ('/chat', '/redo')
+    if not text and message.voice is None:
+        return False
+    if update.effective_chat.id < 0:
+        reply_to = message.reply_to_message
+        return reply_to is not None and reply_to.from_user is not None and reply_to.from_user.id == bot_id
+    return True
+
+# 继续同一段对话的消息：/redo，以及回复机器人的消息和语音；不是回复的消息和 /chat 会开始新会话，旧回答属于另一个问题，不应取消
+def continues_generation(update: Update, bot_id: int) -> bool:
+    message = update.message
+    text = message.text or ''
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0] == '/redo'
+    reply_to = message.reply_to_message
+    return reply_to is not None and reply_to.from_user is not None and reply_to.from_user.id == bot_id
+
+# 更新处理器：不同会话的更新并发处理（群里不同用户互不阻塞），同一会话（用户+聊天）的更新按到达顺序依次处理，保证回复链的上下文顺序
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refs: Dict[str, int] = {}
+        self.waiting = 0
+
+    # 先按会话排队再占用并发名额，避免同一会话的大量更新占满所有名额；多进程部署时不属于本进程的聊天转发给对应的进程
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is not None and Config.WORKER_COUNT > 1 and chat_owner(chat.id) != Config.WORKER_ID:
+            coroutine.close()
+            shared_sync.forward(chat_owner(chat.id), update)
+            return
+        self.waiting += 1
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        # 没有发送者的更新（如频道消息）按聊天排队
+        key = get_session_key(update.effective_user.id, chat.id) if update.effective_user is not None else str(chat.id)
+        # 在排队之前取消同一会话中仍在进行的生成，否则新消息要等旧回答生成完才能处理；会话继续时 /redo 预取不再有用
+        if update.effective_user is not None and starts_new_generation(update, update.get_bot().id):
+            if Config.CANCEL_ON_NEW_MESSAGE and continues_generation(update, update.get_bot().id):
+                session_locks.cancel_generation(key)
+            if not (update.message.text or '').startswith('/redo'):
+                redo_prefetcher.cancel(key)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                del self._refs[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.waiting -= 1
+        # 共享模式下处理函数同步读取设置，先从共享存储加载该用户的设置
+        if isinstance(update, Update) and update.effective_user is not None:
+            await settings_store.prefetch(update.effective_user.id)
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# 记录每次调用Telegram Bot API的耗时
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> Tuple[int, bytes]:
+        api_method = 'file' if '/file/' in url else url.rsplit('/', 1)[-1]
+        with telegram_latency.time(method=api_method):
+            return await super().do_request(url, method, *args, **kwargs)
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b'/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def post_init(application: Application) -> None:
+    # 导入openai和创建连接池较慢，放到后台线程中，不耽误开始接收更新；预热完成前到达的请求通过 get_openai_clients_async 等待它
+    application.bot_data['openai_warmup'] = start_openai_warmup()
+    if shared_state is not None:
+        await start_shared_state(application)
+    if Config.METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, Config.METRICS_HOST, Config.METRICS_PORT)
+
+# 退出前把尚未落盘的设置写入磁盘
+async def post_shutdown(application: Application) -> None:
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+    await draw_queue.shutdown()
+    if shared_state is not None:
+        await shared_sync.stop()
+    await settings_store.flush()
+    if _openai_clients is not None:
+        await _openai_clients.aclose()
+
+def build_application(builder: Optional[ApplicationBuilder] = None) -> Application:
+    update_processor = ChatOrderedUpdateProcessor(Config.CONCURRENT_UPDATES)
+    metrics.gauge('telegram_updates_waiting', '等待处理的Telegram更新数', lambda: update_processor.waiting)
+    application = (
+        (builder or Application.builder())
+        .token(Config.TOKEN)
+        .request(InstrumentedHTTPXRequest(connection_pool_size=256))
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # 使用字典来注册命令
     commands = {
@@ -556,13 +3496,19 @@ def main() -> None:
         "list_models": list_models,
         "list_users": list_users,
         "current_settings": current_settings,
+        "stats": stats,
         "draw": draw,
+        "cancel_draw": cancel_draw,
+        "group_context": group_context_command,
         "chat": chat_command 
     }
 
     for command, handler in commands.items():
         application.add_handler(CommandHandler(command, handler))
 
+    # 记录群聊上下文（单独的处理器组，先于其他处理器运行）
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS & (filters.TEXT | filters.CAPTION) & ~filters.COMMAND, record_group_message), group=-1)
+
     # 添加消息处理器
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND | filters.VOICE, handle_message))
 
@@ -575,7 +3521,42 @@ def main() -> None:
     # 添加错误处理器
     application.add_error_handler(error_handler)
 
-    application.run_polling()
+    return application
+
+# 轮询模式下只能有一个进程从Telegram拉取更新（WORKER_ID为0），其他进程只处理转发给自己的更新
+async def run_forwarded_only(application: Application) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+def main() -> None:
+    Config.validate()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    application = build_application()
+    if Config.WEBHOOK_URL:
+        application.run_webhook(
+            listen=Config.WEBHOOK_LISTEN,
+            port=Config.WEBHOOK_PORT,
+            url_path=Config.WEBHOOK_PATH,
+            webhook_url=f"{Config.WEBHOOK_URL.rstrip('/')}/{Config.WEBHOOK_PATH}",
+            secret_token=Config.WEBHOOK_SECRET or None
+        )
+    elif Config.WORKER_ID == 0:
+        application.run_polling()
+    else:
+        asyncio.run(run_forwarded_only(application))
 
 if __name__ == '__main__':
     main()